@@ -0,0 +1,364 @@
+"""
+Benchmarks indexing and querying on a synthetic repository.
+
+Everything runs offline: chunks and questions are embedded by a deterministic fake embedder and answered by a fake LLM, both with an optional simulated latency. Every stage is timed and the peak RSS is recorded after it, and the results are written as JSON.
+
+Usage:
+	python bench.py --files 2000 --output results.json
+	python bench.py --repo path/to/existing/repo --queries 100
+"""
+from types import SimpleNamespace
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import numpy as np
+IMPORT_STARTED = time.perf_counter()
+import cody
+CODY_IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+WORDS = ["request", "invoice", "user", "session", "cache", "token", "order", "payment", "event", "record", "config", "queue", "report", "account", "batch"]
+
+class FakeEmbeddings:
+	def __init__(self, dimensions=256, latency=0.0):
+		"""
+		Initializes a deterministic embedder that never touches the network.
+
+		Parameters:
+			dimensions (int): (optional) The length of the vectors.
+			latency (float): (optional) Seconds every call sleeps, to stand in for an embedding API.
+
+		Returns:
+			None
+		"""
+		self.dimensions = dimensions
+		self.latency = latency
+		self.model_id = f"fake-{dimensions}"
+
+	def _embed(self, text):
+		seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+		vector = np.random.default_rng(seed).standard_normal(self.dimensions).astype(np.float32)
+		return (vector / np.linalg.norm(vector)).tolist()
+
+	def embed_documents(self, texts):
+		if self.latency:
+			time.sleep(self.latency)
+		return [self._embed(text) for text in texts]
+
+	def embed_query(self, text):
+		if self.latency:
+			time.sleep(self.latency)
+		return self._embed(text)
+
+class PrecomputedEmbeddings:
+	def __init__(self, texts, vectors, fallback):
+		"""
+		Serves vectors computed in an earlier stage, so index building can be timed without embedding again.
+
+		Parameters:
+			texts (list): The embedded texts.
+			vectors (list): Their vectors.
+			fallback (FakeEmbeddings): Embeds texts that were not precomputed.
+
+		Returns:
+			None
+		"""
+		self._vectors = dict(zip(texts, vectors))
+		self._fallback = fallback
+
+	def embed_documents(self, texts):
+		return [self._vectors.get(text) or self._fallback.embed_query(text) for text in texts]
+
+	def embed_query(self, text):
+		return self._vectors.get(text) or self._fallback.embed_query(text)
+
+class FakeLLM:
+	def __init__(self, latency=0.0, words=60):
+		"""
+		Initializes a chat model stand-in that answers every prompt with canned text.
+
+		Parameters:
+			latency (float): (optional) Seconds an answer takes, spread over its streamed chunks.
+			words (int): (optional) The length of the answer in words.
+
+		Returns:
+			None
+		"""
+		self.latency = latency
+		self.words = words
+
+	def stream(self, prompt):
+		for i in range(self.words):
+			if self.latency:
+				time.sleep(self.latency / self.words)
+			yield SimpleNamespace(content=WORDS[i % len(WORDS)] + " ")
+
+	def invoke(self, prompt):
+		return SimpleNamespace(content="".join(chunk.content for chunk in self.stream(prompt)))
+
+def generate_repo(root, files=500, lines=80, depth=3, fanout=4, python_ratio=0.7, seed=0):
+	"""
+	Writes a synthetic repository of Python modules and plain text notes.
+
+	Parameters:
+		root (str): The directory to write into.
+		files (int): (optional) The number of files.
+		lines (int): (optional) The average number of lines per file.
+		depth (int): (optional) How deep directories are nested.
+		fanout (int): (optional) How many subdirectories a directory has.
+		python_ratio (float): (optional) The share of files that are Python modules.
+		seed (int): (optional) Seeds the generator, the same arguments always give the same repository.
+
+	Returns:
+		list: The names of the generated functions, used to build questions.
+	"""
+	rng = random.Random(seed)
+	directories = level = [""]
+	for depth_index in range(depth):
+		level = [os.path.join(parent, f"pkg{depth_index}_{i}") for parent in level for i in range(fanout)]
+		directories = directories + level
+	names = []
+	for i in range(files):
+		directory = os.path.join(root, rng.choice(directories))
+		os.makedirs(directory, exist_ok=True)
+		target = rng.randint(max(1, lines // 2), lines * 3 // 2)
+		if rng.random() < python_ratio:
+			body = [f'"""Module {i}."""', "import os", ""]
+			while len(body) < target:
+				name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{i}_{len(names)}"
+				names.append(name)
+				if rng.random() < 0.3:
+					body += [f"class {name.title().replace('_', '')}:", f"\tdef {name}(self, value):", f"\t\treturn value + {rng.randint(0, 99)}", ""]
+				else:
+					body += [f"def {name}({rng.choice(WORDS)}, {rng.choice(WORDS)}=None):", f'\t"""Handles the {rng.choice(WORDS)} of a {rng.choice(WORDS)}."""']
+					body += [f"\t{rng.choice(WORDS)} = {rng.choice(WORDS)}_{rng.randint(0, 9)}({rng.choice(WORDS)})" for _ in range(rng.randint(2, 8))]
+					body += [f"\treturn {rng.choice(WORDS)}", ""]
+			path = os.path.join(directory, f"module_{i}.py")
+		else:
+			body = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14))) for _ in range(target)]
+			path = os.path.join(directory, f"notes_{i}.txt")
+		with open(path, "w") as file:
+			file.write("\n".join(body) + "\n")
+	return names
+
+def peak_rss():
+	"""
+	Returns the peak resident set size of this process and of its finished children, such as the ingestion workers.
+
+	Returns:
+		dict: {"self": bytes, "children": bytes}, 0 where it cannot be measured.
+	"""
+	return {"self": cody.peak_rss(), "children": cody.peak_rss(children=True)}
+
+def summarize(samples):
+	"""
+	Summarizes latency samples.
+
+	Parameters:
+		samples (list): Durations in seconds.
+
+	Returns:
+		dict: count, mean, p50, p95 and max, in seconds.
+	"""
+	if not samples:
+		return {"count": 0}
+	ordered = sorted(samples)
+	return {
+		"count": len(ordered),
+		"mean": statistics.fmean(ordered),
+		"p50": ordered[len(ordered) // 2],
+		"p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+		"max": ordered[-1],
+	}
+
+class Stages:
+	def __init__(self):
+		"""
+		Initializes the collector of per-stage timings.
+
+		Returns:
+			None
+		"""
+		self.results = {}
+
+	@contextlib.contextmanager
+	def stage(self, name, **counts):
+		"""
+		Times a stage, silencing what cody prints meanwhile.
+
+		Parameters:
+			name (str): The name of the stage.
+			counts: Counters to report with the stage. The block may update the returned dict.
+
+		Returns:
+			contextmanager: Yields the dict of counters.
+		"""
+		started = time.perf_counter()
+		with contextlib.redirect_stdout(io.StringIO()):
+			yield counts
+		self.results[name] = {"seconds": time.perf_counter() - started, **counts, "peak_rss": peak_rss()}
+		print(f"{name:>14}: {self.results[name]['seconds']:.3f}s", file=sys.stderr)
+
+def run(args):
+	"""
+	Runs every stage of the benchmark.
+
+	Parameters:
+		args (argparse.Namespace): The parsed command line.
+
+	Returns:
+		dict: The results.
+	"""
+	workspace = tempfile.mkdtemp(prefix="cody-bench-")
+	root = os.path.abspath(args.repo) if args.repo else os.path.join(workspace, "repo")
+	stages = Stages()
+	embeddings = cody.HashedNgramEmbeddings() if args.local_embeddings else FakeEmbeddings(args.dimensions, args.embed_latency)
+	llm = FakeLLM(args.llm_latency)
+	cody.speak_phrase = lambda text: None
+	cody.CACHE_DIR = os.path.join(workspace, "cache")
+	cody.INGEST_WORKERS = args.workers
+	names = []
+	if not args.repo:
+		with stages.stage("generate", files=args.files) as counts:
+			names = generate_repo(root, args.files, args.lines, args.depth, args.fanout, args.python_ratio, args.seed)
+	cwd = os.getcwd()
+	os.chdir(root)
+	try:
+		handler = cody.FileChangeHandler(ignore_list=cody.IGNORE_THESE, embeddings=embeddings)
+		with stages.stage("walk") as counts:
+			file_paths = list(handler.collect_files())
+			counts["files"] = len(file_paths)
+		contents = {}
+		with stages.stage("read", bytes=0) as counts:
+			for file_path in file_paths:
+				with open(file_path, "rb") as file:
+					contents[file_path] = file.read()
+				counts["bytes"] += len(contents[file_path])
+		file_chunks, file_hashes, file_symbols = {}, {}, {}
+		with stages.stage("chunk") as counts:
+			for file_path, content in contents.items():
+				try:
+					text = content.decode()
+				except UnicodeDecodeError:
+					continue
+				tree = cody.parse_python(file_path, text)
+				file_chunks[file_path] = cody.chunk_file(file_path, text, tree)
+				file_hashes[file_path] = hashlib.sha256(content).hexdigest()
+				file_symbols[file_path] = cody.extract_symbols(tree) if tree is not None else None
+			counts["chunks"] = sum(len(chunks) for chunks in file_chunks.values())
+		texts = [text for chunks in file_chunks.values() for text, _ in chunks]
+		with stages.stage("embed", chunks=len(texts)):
+			vectors = cody.embed_texts(embeddings, texts)
+		handler.embeddings = PrecomputedEmbeddings(texts, vectors, embeddings)
+		with stages.stage("index_build", chunks=len(texts)) as counts:
+			handler.replace_files(file_chunks, file_hashes, file_symbols)
+			handler.optimize_index()
+			counts["index"] = cody.index_type(handler.knowledge_base.index) if handler.knowledge_base is not None else None
+		del contents, file_chunks, texts, vectors
+		names = names or [name for path in file_symbols if file_symbols[path] for name, _, _, _ in file_symbols[path]["definitions"]]
+
+		with stages.stage("ingest_cold", workers=args.workers) as counts:
+			cold = cody.FileChangeHandler(ignore_list=cody.IGNORE_THESE, embeddings=embeddings)
+			cold.update_file_content(announce=False)
+			counts["files"] = len(cold.file_chunk_ids)
+		with stages.stage("ingest_warm", workers=args.workers) as counts:
+			warm = cody.FileChangeHandler(ignore_list=cody.IGNORE_THESE, embeddings=embeddings)
+			warm.update_file_content(announce=False)
+			counts["files"] = len(warm.file_chunk_ids)
+		changed = file_paths[0] if file_paths and not args.repo else None  # Never edit a real repository
+		if changed is not None:
+			with open(changed, "a") as file:
+				file.write("\n# benchmark edit\n")
+			with stages.stage("reindex_one", files=1):
+				warm.update_files([changed], announce=False)
+
+		rng = random.Random(args.seed)
+		questions = []
+		for i in range(args.queries):
+			name = rng.choice(names or WORDS)
+			questions.append(f"where is {name} defined" if i % 5 == 0 else f"How does `{name}` handle the {rng.choice(WORDS)}?")
+		timings = {"navigate": [], "query_embed": [], "search": [], "prompt": [], "llm": [], "total": []}
+		with stages.stage("query", queries=len(questions)):
+			for question in questions:
+				started = time.perf_counter()
+				with warm.lock:
+					navigation = warm.symbol_index.answer(question)
+				timings["navigate"].append(time.perf_counter() - started)
+				if navigation is None:
+					mark = time.perf_counter()
+					query_embedding = embeddings.embed_query(question)
+					timings["query_embed"].append(time.perf_counter() - mark)
+					mark = time.perf_counter()
+					docs = warm.search(question, query_embedding)
+					timings["search"].append(time.perf_counter() - mark)
+					mark = time.perf_counter()
+					prompt = cody.build_prompt(question, docs)
+					timings["prompt"].append(time.perf_counter() - mark)
+					mark = time.perf_counter()
+					cody.generate_response(prompt, llm=llm)
+					timings["llm"].append(time.perf_counter() - mark)
+				timings["total"].append(time.perf_counter() - started)
+		stages.results["query"]["latency"] = {name: summarize(samples) for name, samples in timings.items()}
+	finally:
+		os.chdir(cwd)
+		if not args.keep:
+			shutil.rmtree(workspace, ignore_errors=True)
+
+	return {
+		"config": {key: value for key, value in vars(args).items() if key != "output"},
+		"cody": {
+			"chunk_size": cody.CHUNK_SIZE,
+			"chunk_overlap": cody.CHUNK_OVERLAP,
+			"vector_index": cody.VECTOR_INDEX,
+			"hybrid_search": cody.HYBRID_SEARCH,
+			"retrieval_k": cody.RETRIEVAL_K,
+			"embed_batch_size": cody.EMBED_BATCH_SIZE,
+			"embed_concurrency": cody.EMBED_CONCURRENCY,
+		},
+		"platform": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+		"imports": {"cody": CODY_IMPORT_SECONDS, **cody.IMPORT_TIMES},
+		"stages": stages.results,
+		"metrics": cody.metrics.snapshot(),
+		"peak_rss": peak_rss(),
+		"workspace": workspace if args.keep else None,
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark cody's indexing and query path on a synthetic repository.")
+	parser.add_argument("--repo", help="Benchmark an existing directory instead of generating one")
+	parser.add_argument("--files", type=int, default=500, help="Number of generated files")
+	parser.add_argument("--lines", type=int, default=80, help="Average lines per generated file")
+	parser.add_argument("--depth", type=int, default=3, help="Depth of the generated directory tree")
+	parser.add_argument("--fanout", type=int, default=4, help="Subdirectories per generated directory")
+	parser.add_argument("--python-ratio", type=float, default=0.7, help="Share of generated files that are Python")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--dimensions", type=int, default=256, help="Length of the fake embeddings")
+	parser.add_argument("--embed-latency", type=float, default=0.0, help="Seconds each fake embedding call takes")
+	parser.add_argument("--local-embeddings", action="store_true", help="Embed with cody's local hashed n-gram backend instead of the fake embedder")
+	parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds each fake answer takes")
+	parser.add_argument("--queries", type=int, default=50)
+	parser.add_argument("--workers", type=int, default=cody.INGEST_WORKERS, help="Ingestion worker processes")
+	parser.add_argument("--keep", action="store_true", help="Keep the generated repository and cache")
+	parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+	args = parser.parse_args()
+	results = run(args)
+	if args.output:
+		with open(args.output, "w") as file:
+			json.dump(results, file, indent=2)
+	else:
+		json.dump(results, sys.stdout, indent=2)
+		print()
+
+if __name__ == "__main__":
+	main()
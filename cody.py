@@ -1,180 +1,2647 @@
 from dotenv import load_dotenv
-from langchain.text_splitter import CharacterTextSplitter
-from langchain_google_genai import ChatGoogleGenerativeAI,GoogleGenerativeAIEmbeddings 
-from langchain.vectorstores import FAISS
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from types import SimpleNamespace
+import asyncio
+import importlib
+import socket
+import socketserver
+import stat
 import tempfile
+import ast
+import math
+import re
+import hashlib
+import hmac
+import itertools
+import collections
+import contextlib
 import json
 import time
 import threading
+import queue
+import zlib
 import os
-import speech_recognition as sr
-from gtts import gTTS
-import pygame
-from google_text_to_speech import google_translate_tts
+import sys
+import numpy as np
+try:
+	import resource
+except ImportError:  # Not available on Windows
+	resource = None
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
 ### USER OPTIONS ###
 ### MAX TOKENS PER CALL: MAX TOKENS TO USE FOR CALL
 MAX_TOKENS_PER_CALL = 3000 # MAX TOKENS TO USE FOR CALL
-IGNORE_THESE = ['.venv', '.env', 'static', 'dashboard/static', 'audio', 'license.md', '.github', '__pycache__','.git',"requirements.txt"]
-r = sr.Recognizer()
-embeds = GoogleGenerativeAIEmbeddings(model="models/embedding-001",task_type="retrieval_query")
-llm_text=ChatGoogleGenerativeAI(
-	model="gemini-pro",
-	temperature=0.9,
-	top_p=0.9,
-    top_k=1,
-	convert_system_message_to_human = True)
-
-class FileChangeHandler(FileSystemEventHandler):
-	def __init__(self, ignore_list=[]):
+### CACHE DIR: WHERE CACHED EMBEDDINGS AND THE KNOWLEDGE BASE SNAPSHOT ARE STORED (KEEP IT IN IGNORE_THESE)
+CACHE_DIR = ".cody_cache"
+SNAPSHOT_VERSION = 4  # Bumped whenever the snapshot layout changes
+### SNAPSHOT INTERVAL: SECONDS AFTER A RE-INDEX BEFORE THE SNAPSHOT IS SAVED IN THE BACKGROUND (IT IS ALSO SAVED ON EXIT)
+SNAPSHOT_INTERVAL = 60.0
+EMBEDDING_MODEL = "models/embedding-001"
+### EMBEDDING BACKEND: "google" EMBEDS WITH EMBEDDING_MODEL OVER THE API, "local" NEVER TOUCHES THE NETWORK: IT USES THE
+### SENTENCE-TRANSFORMERS MODEL SAVED IN LOCAL_EMBEDDING_MODEL IF THERE IS ONE AND HASHED N-GRAM VECTORS OTHERWISE
+### (SWITCHING BACKENDS REBUILDS THE KNOWLEDGE BASE ON THE NEXT START)
+EMBEDDING_BACKEND = "google"
+LOCAL_EMBEDDING_MODEL = os.path.join(CACHE_DIR, "models", "embedding")
+HASHED_EMBEDDING_DIMENSIONS = 1024
+### REINDEX QUIET WINDOW: SECONDS A FILE MUST STAY UNCHANGED BEFORE IT IS RE-INDEXED
+REINDEX_QUIET_WINDOW = 1.0
+### INGEST WORKERS: PROCESSES USED TO READ AND CHUNK FILES ON A FULL INDEX (1 KEEPS EVERYTHING IN THIS PROCESS)
+INGEST_WORKERS = os.cpu_count() or 1
+### CHUNK SIZE / OVERLAP: MAX CHARACTERS PER CHUNK AND CHARACTERS REPEATED BETWEEN CHUNKS THAT HAVE TO SPLIT A LONG BLOCK
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+### FILE LIMITS: FILES OVER MAX_FILE_BYTES ARE SKIPPED, BINARY FILES ARE DETECTED FROM THEIR FIRST SNIFF_BYTES
+### GENERATED/MINIFIED FILES (BY SUFFIX, OR BY LONG LINES WITH NEXT TO NO WHITESPACE) ARE CUT TO TRUNCATE_GENERATED_BYTES (0 SKIPS THEM)
+MAX_FILE_BYTES = 1000000
+SNIFF_BYTES = 8192
+MINIFIED_LINE_LENGTH = 300
+TRUNCATE_GENERATED_BYTES = 0
+GENERATED_SUFFIXES = ('.min.js', '.min.css', '.map', '.lock', 'package-lock.json', '.pb.go', '_pb2.py', '.snap')
+### INDEX BATCH SIZE: CHUNKS EMBEDDED AND ADDED TO THE KNOWLEDGE BASE AT A TIME, BOUNDS MEMORY ON LARGE REPOS
+INDEX_BATCH_SIZE = 512
+### EMBED BATCH SIZE / CONCURRENCY: CHUNKS PER EMBEDDING REQUEST AND REQUESTS IN FLIGHT AT ONCE
+EMBED_BATCH_SIZE = 32
+EMBED_CONCURRENCY = 8
+### QUERY CACHE: QUESTION EMBEDDINGS KEPT IN MEMORY, AND WHETHER THEY ARE ALSO KEPT IN CACHE_DIR BETWEEN RUNS
+QUERY_CACHE_SIZE = 256
+PERSIST_QUERY_CACHE = True
+### ANSWER CACHE SIZE: ANSWERS KEPT FOR REPEATED QUESTIONS ON UNCHANGED CODE (0 DISABLES IT)
+ANSWER_CACHE_SIZE = 128
+### STREAM RESPONSES: PRINT THE ANSWER AS IT IS GENERATED INSTEAD OF WAITING FOR ALL OF IT (LINE BY LINE WHILE OTHER QUESTIONS ARE ANSWERED TOO)
+STREAM_RESPONSES = True
+### VECTOR INDEX: "flat" (EXACT), "hnsw" OR "ivf" (APPROXIMATE), OR "auto" FOR FLAT UP TO ANN_MIN_CHUNKS CHUNKS AND HNSW ABOVE
+### ("auto" ONLY GOES BACK TO FLAT BELOW ANN_KEEP_CHUNKS, SO A KNOWLEDGE BASE NEAR THE THRESHOLD IS NOT REBUILT ON EVERY EDIT)
+### ANN INDEXES DROP DELETED CHUNKS LAZILY AND ARE REBUILT ONCE MORE THAN TOMBSTONE_RATIO OF THEIR ENTRIES ARE DELETED
+VECTOR_INDEX = "auto"
+ANN_MIN_CHUNKS = 50000
+ANN_KEEP_CHUNKS = 40000
+HNSW_M = 32
+HNSW_EF_SEARCH = 64
+IVF_NPROBE = 16
+TOMBSTONE_RATIO = 0.2
+### RETRIEVAL: CHUNKS GIVEN TO THE LLM PER QUESTION, AND WHETHER KEYWORD (BM25) HITS ARE FUSED WITH THE VECTOR HITS
+RETRIEVAL_K = 10  # More than fits is fine, build_prompt packs them into MAX_TOKENS_PER_CALL by relevance
+HYBRID_SEARCH = True
+### TTS CONCURRENCY: SENTENCES OF A SPOKEN ANSWER SYNTHESIZED AT ONCE WHILE EARLIER ONES PLAY
+TTS_CONCURRENCY = 4
+### QUESTIONS IN FLIGHT: HOW MANY QUESTIONS ARE ANSWERED AT ONCE. EVERY ANSWER LINE IS TAGGED WITH THE NUMBER OF ITS QUESTION
+QUESTIONS_IN_FLIGHT = 4
+### LLM SETTINGS: PASSED TO THE CHAT MODEL, ALSO PART OF THE ANSWER CACHE KEY
+LLM_SETTINGS = {"model": "gemini-pro", "temperature": 0.9, "top_p": 0.9, "top_k": 1}
+### ROOTS: THE DIRECTORIES TO INDEX, EACH IN ITS OWN KNOWLEDGE BASE SHARD. START A QUESTION WITH @path TO ONLY SEARCH UNDER path
+ROOTS = ['.']
+### USE GITIGNORE: ALSO SKIP EVERYTHING MATCHED BY .gitignore FILES (IGNORE_THESE ACCEPTS THE SAME GLOB SYNTAX)
+USE_GITIGNORE = True
+IGNORE_THESE = ['.venv', '.env*', '*.env', 'static', 'dashboard/static', 'audio', 'license.md', '.github', '__pycache__','.git',"requirements.txt", CACHE_DIR]
+### DAEMON: ADDRESS THE QUERY API OF `python cody.py --daemon` LISTENS ON. SET DAEMON_SOCKET TO A PATH TO SERVE ON A UNIX SOCKET INSTEAD
+### SET CODY_DAEMON_TOKEN IN .env TO REQUIRE "Authorization: Bearer <token>" ON EVERY REQUEST
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = 8765
+DAEMON_SOCKET = None
+DAEMON_TOKEN = os.getenv("CODY_DAEMON_TOKEN")
+### METRICS: PER-STAGE TIMINGS, COUNTS, BYTES, TOKEN USAGE AND PEAK MEMORY. METRICS_FILE APPENDS ONE JSON LINE PER MEASUREMENT,
+### METRICS_PORT SERVES THEM AS PROMETHEUS TEXT ON http://DAEMON_HOST:METRICS_PORT/metrics (THE DAEMON ALWAYS SERVES /metrics)
+METRICS_FILE = None
+METRICS_PORT = None
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+### SHOW IMPORT TIMES: PRINT HOW LONG EVERY LAZILY IMPORTED LIBRARY TOOK TO LOAD ONCE CODY HAS STARTED
+SHOW_IMPORT_TIMES = False
+
+# langchain, the Google clients, watchdog and the speech and audio libraries are imported on first use, and the
+# clients built on first use, so a terminal session never loads the speech stack and importing cody stays cheap
+IMPORT_TIMES = {}  # Module -> seconds its first import took
+llm_text = None
+embeds = None
+query_embeddings = None
+speech_output = False  # Whether Cody speaks, only turned on for speech I/O
+_clients_lock = threading.Lock()
+
+def timed_import(name):
+	"""
+	Imports a module, recording how long the first import took in IMPORT_TIMES.
+
+	Parameters:
+		name (str): The name of the module.
+
+	Returns:
+		module: The module.
+	"""
+	module = sys.modules.get(name)
+	if module is not None:
+		return module
+	started = time.perf_counter()
+	module = importlib.import_module(name)
+	IMPORT_TIMES.setdefault(name, time.perf_counter() - started)
+	return module
+
+def import_report():
+	"""
+	Describes how long the lazily imported libraries took to load.
+
+	Returns:
+		str: One line per module, slowest first.
+	"""
+	lines = [f"  {seconds * 1000:8.1f} ms  {name}" for name, seconds in sorted(IMPORT_TIMES.items(), key=lambda item: -item[1])]
+	return "\U000023F1 Import times:\n" + ("\n".join(lines) if lines else "  nothing imported lazily yet")
+
+class Metrics:
+	def __init__(self, buckets=METRIC_BUCKETS):
+		"""
+		Initializes the registry of per-stage measurements.
+
+		Every stage (walk, read, chunk, embed, index_build, query_embed, search, llm, tts, ...) gets a latency histogram and totals of the items and bytes it handled. Token usage is counted separately, marking whether the chat model reported it or it was estimated.
+
+		Parameters:
+			buckets (tuple): (optional) The upper bounds of the histogram buckets, in seconds.
+
+		Returns:
+			None
+		"""
+		self.buckets = buckets
+		self._stages = {}  # Stage -> {"counts", "sum", "count", "items", "bytes", "max"}
+		self._tokens = collections.Counter()  # (kind, source) -> tokens
+		self._lock = threading.Lock()
+		self._file = None
+		self.buffered = None  # Samples kept for the parent process when running in an ingestion worker
+
+	def observe(self, stage, seconds, items=1, size=0):
+		"""
+		Records one measurement of a stage.
+
+		Parameters:
+			stage (str): The name of the stage.
+			seconds (float): How long it took.
+			items (int): (optional) How many items (files, chunks, questions...) it handled.
+			size (int): (optional) How many bytes it handled.
+
+		Returns:
+			None
+		"""
+		with self._lock:
+			entry = self._stages.get(stage)
+			if entry is None:
+				entry = self._stages[stage] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0, "items": 0, "bytes": 0, "max": 0.0}
+			for i, bound in enumerate(self.buckets):
+				if seconds <= bound:
+					entry["counts"][i] += 1
+			entry["sum"] += seconds
+			entry["count"] += 1
+			entry["items"] += items
+			entry["bytes"] += size
+			entry["max"] = max(entry["max"], seconds)
+			if self.buffered is not None:
+				self.buffered.append((stage, seconds, items, size))
+			self._log({"stage": stage, "seconds": seconds, "items": items, "bytes": size})
+
+	@contextlib.contextmanager
+	def measure(self, stage, items=1, size=0):
+		"""
+		Times a block as one measurement of a stage.
+
+		Parameters:
+			stage (str): The name of the stage.
+			items (int): (optional) How many items the block handles.
+			size (int): (optional) How many bytes the block handles.
+
+		Returns:
+			contextmanager: Yields a dict whose "items" and "size" the block may update once it knows them.
+		"""
+		counts = {"items": items, "size": size}
+		started = time.perf_counter()
+		try:
+			yield counts
+		finally:
+			self.observe(stage, time.perf_counter() - started, counts["items"], counts["size"])
+
+	def add_tokens(self, input_tokens, output_tokens, reported):
+		"""
+		Records the token usage of one chat model call.
+
+		Parameters:
+			input_tokens (int): The tokens of the prompt.
+			output_tokens (int): The tokens of the answer.
+			reported (bool): Whether the chat model reported the usage, rather than it being estimated.
+
+		Returns:
+			None
+		"""
+		source = "reported" if reported else "estimated"
+		with self._lock:
+			self._tokens["input", source] += input_tokens
+			self._tokens["output", source] += output_tokens
+			self._log({"stage": "tokens", "input": input_tokens, "output": output_tokens, "source": source})
+
+	def drain(self):
+		"""
+		Returns and forgets the samples buffered in an ingestion worker.
+
+		Returns:
+			list: (stage, seconds, items, bytes) samples, to be passed to merge() in the parent process.
+		"""
+		with self._lock:
+			samples, self.buffered = self.buffered or [], []
+		return samples
+
+	def merge(self, samples):
+		"""
+		Records the samples drained from an ingestion worker.
+
+		Parameters:
+			samples (list): The drained samples.
+
+		Returns:
+			None
+		"""
+		for sample in samples:
+			self.observe(*sample)
+
+	def _log(self, record):
+		# Appends a JSON line to METRICS_FILE, called with the lock held
+		if not METRICS_FILE or self.buffered is not None:
+			return
+		try:
+			if self._file is None:
+				self._file = open(METRICS_FILE, 'a', buffering=1)
+			self._file.write(json.dumps({"time": time.time(), **record}) + "\n")
+		except OSError as e:
+			print(f"\U000026A0 Error in writing metrics: {e}")
+
+	def snapshot(self):
+		"""
+		Summarizes every measurement so far.
+
+		Returns:
+			dict: Per stage: count, total, mean and max seconds, p50 and p95 estimated from the buckets, items and bytes. Plus the token usage and the peak RSS in bytes.
+		"""
+		with self._lock:
+			stages = {}
+			for stage, entry in self._stages.items():
+				def quantile(q):
+					for bound, count in zip(self.buckets, entry["counts"]):
+						if count >= q * entry["count"]:
+							return bound
+					return entry["max"]
+				stages[stage] = {
+					"count": entry["count"], "seconds": entry["sum"], "mean": entry["sum"] / entry["count"], "max": entry["max"],
+					"p50": quantile(0.5), "p95": quantile(0.95), "items": entry["items"], "bytes": entry["bytes"],
+				}
+			tokens = {f"{kind}_{source}": count for (kind, source), count in self._tokens.items()}
+		return {"stages": stages, "tokens": tokens, "peak_rss_bytes": peak_rss()}
+
+	def prometheus(self):
+		"""
+		Renders every measurement in the Prometheus text format.
+
+		Returns:
+			str: The exposition text.
+		"""
+		lines = [
+			"# HELP cody_stage_seconds Time spent in each stage.",
+			"# TYPE cody_stage_seconds histogram",
+		]
+		with self._lock:
+			stages = {stage: dict(entry, counts=list(entry["counts"])) for stage, entry in self._stages.items()}
+			tokens = dict(self._tokens)
+		for stage, entry in sorted(stages.items()):
+			for bound, count in zip(self.buckets, entry["counts"]):
+				lines.append(f'cody_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+			lines.append(f'cody_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {entry["count"]}')
+			lines.append(f'cody_stage_seconds_sum{{stage="{stage}"}} {entry["sum"]}')
+			lines.append(f'cody_stage_seconds_count{{stage="{stage}"}} {entry["count"]}')
+		for name, key, help_text in (("items", "items", "Items (files, chunks, questions) handled by each stage."), ("bytes", "bytes", "Bytes handled by each stage.")):
+			lines += [f"# HELP cody_stage_{name}_total {help_text}", f"# TYPE cody_stage_{name}_total counter"]
+			lines += [f'cody_stage_{name}_total{{stage="{stage}"}} {entry[key]}' for stage, entry in sorted(stages.items())]
+		lines += ["# HELP cody_tokens_total Chat model tokens, as reported by the model or estimated.", "# TYPE cody_tokens_total counter"]
+		lines += [f'cody_tokens_total{{kind="{kind}",source="{source}"}} {count}' for (kind, source), count in sorted(tokens.items())]
+		lines += ["# HELP cody_peak_rss_bytes Peak resident set size of the process.", "# TYPE cody_peak_rss_bytes gauge", f"cody_peak_rss_bytes {peak_rss()}"]
+		return "\n".join(lines) + "\n"
+
+def peak_rss(children=False):
+	"""
+	Returns the peak resident set size of this process.
+
+	Parameters:
+		children (bool): (optional) Whether to return the largest peak of its finished child processes, such as the ingestion workers, instead.
+
+	Returns:
+		int: Bytes, or 0 where the resource module is not available.
+	"""
+	if resource is None:
+		return 0
+	usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+	return usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)  # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+
+metrics = Metrics()
+
+def buffer_metrics():
+	"""
+	Makes an ingestion worker keep its measurements for the parent process, see Metrics.drain. Used as the pool initializer.
+
+	Returns:
+		None
+	"""
+	metrics.buffered = []
+
+def chat_model():
+	"""
+	Returns the chat model, building it on first use.
+
+	Returns:
+		ChatGoogleGenerativeAI: The chat model.
+	"""
+	global llm_text
+	with _clients_lock:
+		if llm_text is None:
+			llm_text = timed_import("langchain_google_genai").ChatGoogleGenerativeAI(
+				**LLM_SETTINGS,
+				convert_system_message_to_human = True)
+		return llm_text
+
+class HashedNgramEmbeddings:
+	def __init__(self, dimensions=HASHED_EMBEDDING_DIMENSIONS, ngram=3):
+		"""
+		Initializes embeddings computed locally from the terms of a text and their character n-grams.
+
+		Every feature is hashed into one of dimensions buckets with a hashed sign, weighted by 1 + log of its count, and the vector is L2-normalized. No corpus statistics are involved, so a chunk keeps its vector however the knowledge base changes. Close identifiers ("parse_config", "config_parser") share most of their n-grams and end up close together.
+
+		Parameters:
+			dimensions (int): (optional) The length of the vectors.
+			ngram (int): (optional) The length of the character n-grams.
+
+		Returns:
+			None
+		"""
+		self.dimensions = dimensions
+		self.ngram = ngram
+		self.model_id = f"hashed-ngrams-{dimensions}-{ngram}"
+
+	def embed(self, text):
+		"""
+		Embeds a text.
+
+		Parameters:
+			text (str): The text.
+
+		Returns:
+			numpy.ndarray: The normalized float32 vector.
+		"""
+		counts = collections.Counter()
+		for term in tokenize(text):
+			counts[term] += 1
+			padded = f"<{term}>"
+			for i in range(len(padded) - self.ngram + 1):
+				counts[padded[i:i + self.ngram]] += 1
+		vector = np.zeros(self.dimensions, dtype=np.float32)
+		if not counts:
+			return vector
+		hashes = np.fromiter((zlib.crc32(feature.encode()) for feature in counts), dtype=np.int64, count=len(counts))
+		weights = 1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+		np.add.at(vector, (hashes >> 1) % self.dimensions, np.where(hashes & 1, weights, -weights))
+		norm = np.linalg.norm(vector)
+		return vector / norm if norm else vector
+
+	def embed_documents(self, texts):
+		return [self.embed(text).tolist() for text in texts]
+
+	def embed_query(self, text):
+		return self.embed(text).tolist()
+
+class LocalModelEmbeddings:
+	def __init__(self, path):
+		"""
+		Initializes embeddings computed by a sentence-transformers model saved on disk.
+
+		Parameters:
+			path (str): The directory of the saved model.
+
+		Returns:
+			None
+
+		Raises:
+			ImportError: If sentence-transformers is not installed.
+		"""
+		self.model = timed_import("sentence_transformers").SentenceTransformer(path, device="cpu")
+		self.model_id = "local:" + os.path.basename(os.path.normpath(path))
+
+	def embed_documents(self, texts):
+		return self.model.encode(list(texts), normalize_embeddings=True).tolist()
+
+	def embed_query(self, text):
+		return self.model.encode([text], normalize_embeddings=True)[0].tolist()
+
+def build_embedder(backend=EMBEDDING_BACKEND):
+	"""
+	Builds the embeddings of the configured backend.
+
+	Parameters:
+		backend (str): (optional) "google" or "local", see EMBEDDING_BACKEND.
+
+	Returns:
+		Embeddings: The embeddings, without any caching.
+	"""
+	if backend == "local":
+		if os.path.isdir(LOCAL_EMBEDDING_MODEL):
+			try:
+				return LocalModelEmbeddings(LOCAL_EMBEDDING_MODEL)
+			except ImportError:
+				print(f"\U000026A0 sentence-transformers is not installed, ignoring the model in {LOCAL_EMBEDDING_MODEL}")
+		return HashedNgramEmbeddings()
+	return timed_import("langchain_google_genai").GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL,task_type="retrieval_query")
+
+def embedding_id(embeddings):
+	"""
+	Names the model behind some embeddings. Snapshots and caches are only reused for the same name.
+
+	Parameters:
+		embeddings (Embeddings): The embeddings.
+
+	Returns:
+		str: The model name.
+	"""
+	return getattr(embeddings, "model_id", EMBEDDING_MODEL)
+
+def default_embedder():
+	"""
+	Returns the embeddings of the configured backend, building them on first use.
+
+	Returns:
+		Embeddings: The embeddings shared by questions and chunks.
+	"""
+	global embeds
+	with _clients_lock:
+		if embeds is None:
+			embeds = build_embedder()
+		return embeds
+
+def build_embeddings(underlying=None):
+	"""
+	Builds the embeddings used for the chunks of the knowledge base.
+
+	Every embedding is cached on disk under CACHE_DIR, keyed by a hash of the chunk text and namespaced by the embedding model, so identical chunks are only ever embedded once across runs. Hashed n-gram vectors are cheaper to compute than to read back and are not cached.
+
+	Parameters:
+		underlying (Embeddings): (optional) The embeddings to cache. Defaults to default_embedder().
+
+	Returns:
+		Embeddings: The disk-cached embeddings.
+	"""
+	underlying = underlying if underlying is not None else default_embedder()
+	if isinstance(underlying, HashedNgramEmbeddings):
+		return underlying
+	store = timed_import("langchain.storage").LocalFileStore(os.path.join(CACHE_DIR, "embeddings"))
+	return timed_import("langchain.embeddings").CacheBackedEmbeddings.from_bytes_store(underlying, store, namespace=embedding_id(underlying).replace("/", "_").replace(":", "_") + "_")
+
+def embed_texts(embeddings, texts, batch_size=EMBED_BATCH_SIZE, concurrency=EMBED_CONCURRENCY):
+	"""
+	Embeds texts in batches, with several batches in flight at once to hide the latency of the embedding API.
+
+	Parameters:
+		embeddings (Embeddings): The embeddings to use.
+		texts (list): The texts to embed.
+		batch_size (int): (optional) The number of texts per embedding request.
+		concurrency (int): (optional) The maximum number of requests in flight.
+
+	Returns:
+		list: The vector of every text, in order.
+	"""
+	with metrics.measure("embed", items=len(texts), size=sum(len(text) for text in texts)):
+		return _embed_batches(embeddings, texts, batch_size, concurrency)
+
+def _embed_batches(embeddings, texts, batch_size, concurrency):
+	batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+	if len(batches) <= 1 or concurrency <= 1:
+		return [vector for batch in batches for vector in embeddings.embed_documents(batch)]
+	vectors, done = [], 0
+	with ThreadPoolExecutor(max_workers=min(concurrency, len(batches))) as executor:
+		# map keeps the batches in order while they are embedded concurrently
+		for batch_vectors in executor.map(embeddings.embed_documents, batches):
+			vectors.extend(batch_vectors)
+			done += len(batch_vectors)
+			print(f"\r\U0001F9EE Embedded {done}/{len(texts)} chunks", end="" if done < len(texts) else "\n", flush=True)
+	return vectors
+
+def chunk_lines(lines, start, end, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+	"""
+	Splits a range of lines into chunks of whole lines.
+
+	Consecutive chunks repeat up to chunk_overlap characters of trailing lines so that text cut at a chunk border is still found in one piece.
+
+	Parameters:
+		lines (list): All lines of the file, without line endings.
+		start (int): The first line of the range, 1-based.
+		end (int): The last line of the range, inclusive.
+		chunk_size (int): (optional) The maximum number of characters per chunk. A single longer line becomes its own chunk.
+		chunk_overlap (int): (optional) The number of characters repeated between consecutive chunks.
+
+	Returns:
+		list: (start_line, end_line) of every chunk.
+	"""
+	spans = []
+	first, size = start, 0
+	for number in range(start, end + 1):
+		length = len(lines[number - 1]) + 1
+		if size and size + length > chunk_size:
+			spans.append((first, number - 1))
+			# Step back over the lines that fit in the overlap
+			first, size = number, 0
+			while first - 1 > spans[-1][0] and size + len(lines[first - 2]) + 1 <= chunk_overlap:
+				first -= 1
+				size += len(lines[first - 1]) + 1
+		size += length
+	if size:
+		spans.append((first, end))
+	return spans
+
+def python_blocks(nodes, first_line):
+	"""
+	Groups a body of Python statements into blocks that each hold one function, one class or a run of other statements.
+
+	Comments and blank lines in front of a statement are kept with it, so a function keeps its leading comment.
+
+	Parameters:
+		nodes (list): The statements of a module or class body.
+		first_line (int): The first line that may belong to the first block.
+
+	Returns:
+		list: (start_line, end_line, node) of every block. node is None for a run of other statements.
+	"""
+	blocks = []
+	for node in nodes:
+		start = min([node.lineno] + [decorator.lineno for decorator in getattr(node, 'decorator_list', [])])
+		start = min(start, blocks[-1][1] + 1 if blocks else first_line)
+		if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+			blocks.append((start, node.end_lineno, node))
+		elif blocks and blocks[-1][2] is None:
+			blocks[-1] = (blocks[-1][0], node.end_lineno, None)
+		else:
+			blocks.append((start, node.end_lineno, None))
+	return blocks
+
+def chunk_python(lines, tree):
+	"""
+	Splits Python source into chunks along function and class boundaries.
+
+	Every function, every class that fits in CHUNK_SIZE and every run of other top-level statements becomes one chunk. Larger classes are split into their header and their methods. Blocks that are still too large fall back to chunk_lines.
+
+	Parameters:
+		lines (list): All lines of the file, without line endings.
+		tree (ast.Module): The parsed source of the file.
+
+	Returns:
+		list: (start_line, end_line) of every chunk.
+	"""
+	spans = []
+	def add_blocks(blocks):
+		for start, end, node in blocks:
+			while start < end and not lines[start - 1].strip():
+				start += 1  # Skip the blank lines before a block
+			if sum(len(line) + 1 for line in lines[start - 1:end]) <= CHUNK_SIZE:
+				spans.append((start, end))
+			elif isinstance(node, ast.ClassDef) and node.body:
+				members = python_blocks(node.body, node.body[0].lineno)
+				if members[0][0] > start:
+					spans.extend(chunk_lines(lines, start, members[0][0] - 1))  # The class line and its docstring
+				add_blocks(members)
+			else:
+				spans.extend(chunk_lines(lines, start, end))
+	add_blocks(python_blocks(tree.body, 1))
+	return spans
+
+def parse_python(file_path, text):
+	"""
+	Parses a Python file.
+
+	Parameters:
+		file_path (str): The path of the file the text was read from.
+		text (str): The content of the file.
+
+	Returns:
+		ast.Module: The syntax tree, or None if the file is not Python or does not parse.
+	"""
+	if not file_path.endswith('.py'):
+		return None
+	try:
+		return ast.parse(text)
+	except (SyntaxError, ValueError):
+		return None
+
+def chunk_file(file_path, text, tree=None):
+	"""
+	Splits the text of a single file into chunks with their provenance.
+
+	Python files are split by function and class with ast. Every other file, or Python that does not parse, is split into runs of whole lines.
+
+	Parameters:
+		file_path (str): The path of the file the text was read from.
+		text (str): The content of the file.
+		tree (ast.Module): (optional) The tree from parse_python, to avoid parsing twice.
+
+	Returns:
+		list: (chunk_text, metadata) pairs. metadata holds the "source" path and the 1-based "start_line" and "end_line" of the chunk.
+	"""
+	lines = text.splitlines()
+	if tree is None:
+		tree = parse_python(file_path, text)
+	spans = chunk_python(lines, tree) if tree is not None else chunk_lines(lines, 1, len(lines))
+	chunks = []
+	for start, end in spans:
+		chunk_text = "\n".join(lines[start - 1:end])
+		if chunk_text.strip():
+			chunks.append((chunk_text, {"source": file_path, "start_line": start, "end_line": end}))
+	return chunks
+
+def extract_symbols(tree):
+	"""
+	Collects the definitions and references of a Python syntax tree.
+
+	Parameters:
+		tree (ast.Module): The parsed source of a file.
+
+	Returns:
+		dict: "definitions" holds [name, qualified name, kind, line] entries for every function, method, class and module-level variable. "references" holds [name, line, is_call] entries for every other use of a name or attribute.
+	"""
+	definitions, references = [], []
+	def visit(node, scope):
+		for child in ast.iter_child_nodes(node):
+			if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+				kind = "class" if isinstance(child, ast.ClassDef) else ("method" if scope and scope[-1][1] == "class" else "function")
+				definitions.append([child.name, ".".join([name for name, _ in scope] + [child.name]), kind, child.lineno])
+				visit(child, scope + [(child.name, kind)])
+				continue
+			if not scope and isinstance(child, (ast.Assign, ast.AnnAssign)):
+				for target in (child.targets if isinstance(child, ast.Assign) else [child.target]):
+					if isinstance(target, ast.Name):
+						definitions.append([target.id, target.id, "variable", child.lineno])
+			if isinstance(child, ast.Call):
+				func = child.func
+				name = func.id if isinstance(func, ast.Name) else (func.attr if isinstance(func, ast.Attribute) else None)
+				if name:
+					references.append([name, child.lineno, True])
+			elif isinstance(child, ast.Name) and isinstance(child.ctx, ast.Load):
+				references.append([child.id, child.lineno, False])
+			elif isinstance(child, ast.Attribute) and isinstance(child.ctx, ast.Load):
+				references.append([child.attr, child.lineno, False])
+			visit(child, scope)
+	visit(tree, [])
+	# A call is also visited as a plain name or attribute, keep only the call
+	calls = {(name, line) for name, line, is_call in references if is_call}
+	references = [ref for ref in references if ref[2] or (ref[0], ref[1]) not in calls]
+	return {"definitions": definitions, "references": references}
+
+def sniff_file(file_path, head, size):
+	"""
+	Decides from the first bytes of a file how much of it is worth indexing.
+
+	Parameters:
+		file_path (str): The path of the file.
+		head (bytes): The first SNIFF_BYTES of the file.
+		size (int): The size of the file in bytes.
+
+	Returns:
+		int: The number of bytes to index, 0 to skip the file.
+	"""
+	if size > MAX_FILE_BYTES or b"\0" in head:
+		return 0
+	# Text has next to no control characters besides whitespace
+	control = sum(1 for byte in head if byte < 32 and byte not in b"\t\n\r\f\b")
+	if head and control / len(head) > 0.1:
+		return 0
+	# Minified code has long lines and next to no whitespace, prose, JSON lines or CSV with long lines still have plenty
+	lines = head.count(b"\n") + 1
+	whitespace = sum(head.count(byte) for byte in (b" ", b"\t", b"\n", b"\r"))
+	minified = len(head) / lines > MINIFIED_LINE_LENGTH and whitespace < 0.05 * len(head)
+	if file_path.endswith(GENERATED_SUFFIXES) or minified:
+		return min(size, TRUNCATE_GENERATED_BYTES)
+	return size
+
+def load_file(file_path, known_hash=None):
+	"""
+	Reads, hashes and splits a single file.
+
+	This runs inside the ingestion worker processes, so it only depends on its arguments and returns plain picklable values.
+
+	Parameters:
+		file_path (str): The path of the file to load.
+		known_hash (str): (optional) The hash the file had when it was last indexed.
+
+	Returns:
+		tuple: (file_path, file_hash, chunks, symbols). file_hash is None if the file cannot be read or is skipped by sniff_file. chunks holds the chunk_file pairs, it is None if the content still matches known_hash, and empty if the file cannot be decoded. symbols holds the extract_symbols result of Python files, otherwise None.
+	"""
+	started = time.perf_counter()
+	try:
+		with open(file_path, 'rb') as file:
+			size = os.fstat(file.fileno()).st_size
+			head = file.read(SNIFF_BYTES)
+			limit = sniff_file(file_path, head, size)
+			if limit == 0:
+				return file_path, None, [], None
+			content = head + file.read(limit - len(head)) if limit > len(head) else head[:limit]
+	except OSError:
+		return file_path, None, [], None
+	truncated = limit < size
+	if truncated:
+		content = content[:content.rfind(b"\n") + 1] or content  # Keep whole lines
+	file_hash = hashlib.sha256(content).hexdigest()
+	metrics.observe("read", time.perf_counter() - started, size=len(content))
+	if file_hash == known_hash:
+		return file_path, file_hash, None, None
+	with metrics.measure("chunk", size=len(content)) as counts:
+		try:
+			text = content.decode(errors='ignore' if truncated else 'strict')
+			tree = parse_python(file_path, text)
+			chunks = chunk_file(file_path, text, tree)
+			symbols = extract_symbols(tree) if tree is not None else None
+		except Exception as e:
+			chunks, symbols = [], None
+			#print(f'\U000026A0 Error reading file {file_path}: {str(e)}')
+		counts["items"] = len(chunks)
+	return file_path, file_hash, chunks, symbols
+
+def load_files(file_paths, known_hashes):
+	"""
+	Loads a group of files with load_file. Used to hand work to the ingestion workers in groups rather than one file at a time.
+
+	Parameters:
+		file_paths (list): The paths of the files to load.
+		known_hashes (list): The known hash of every path, or None.
+
+	Returns:
+		tuple: The load_file result of every path, and the metrics samples measured meanwhile.
+	"""
+	return [load_file(file_path, known_hash) for file_path, known_hash in zip(file_paths, known_hashes)], metrics.drain()
+
+def ingest_files(file_paths, known_hashes=None, workers=None, group_size=16):
+	"""
+	Loads many files, spreading the reading, parsing and chunking over a pool of processes.
+
+	Paths are consumed lazily and only a bounded number of groups is in flight at a time, so neither the paths nor the loaded chunks of the whole repository are ever held in memory at once. Results are yielded in the order of file_paths as soon as they are ready.
+
+	Parameters:
+		file_paths (iterable): The paths of the files to load.
+		known_hashes (dict): (optional) File path -> hash it had when it was last indexed, see load_file.
+		workers (int): (optional) Number of worker processes, INGEST_WORKERS by default. 1 or less loads the files in this process.
+		group_size (int): (optional) Number of files handed to a worker at a time.
+
+	Returns:
+		generator: The load_file result of every path.
+	"""
+	known_hashes = known_hashes or {}
+	workers = INGEST_WORKERS if workers is None else workers
+	if workers <= 1:
+		for file_path in file_paths:
+			yield load_file(file_path, known_hashes.get(file_path))
+		return
+	file_paths = iter(file_paths)
+	with ProcessPoolExecutor(max_workers=workers, initializer=buffer_metrics) as executor:
+		in_flight = collections.deque()
+		while True:
+			group = list(itertools.islice(file_paths, group_size))
+			if group:
+				in_flight.append(executor.submit(load_files, group, [known_hashes.get(path) for path in group]))
+			if in_flight and (not group or len(in_flight) >= workers * 2):
+				results, samples = in_flight.popleft().result()
+				metrics.merge(samples)
+				yield from results
+			elif not group:
+				return
+
+def gitignore_to_regex(pattern):
+	"""
+	Compiles one gitignore-style pattern.
+
+	Parameters:
+		pattern (str): A line of a .gitignore file or an entry of IGNORE_THESE.
+
+	Returns:
+		tuple: (regex, negate, dir_only), or None for blank lines and comments. The regex matches "/"-separated paths relative to the directory the pattern belongs to.
+	"""
+	pattern = pattern.rstrip("\n").rstrip()
+	if not pattern or pattern.startswith("#"):
+		return None
+	negate = pattern.startswith("!")
+	if negate or pattern.startswith("\\"):
+		pattern = pattern[1:]
+	dir_only = pattern.endswith("/")
+	pattern = pattern.rstrip("/")
+	if not pattern:
+		return None
+	# A pattern with a slash in it is anchored to its directory, otherwise it matches at any depth
+	anchored = "/" in pattern
+	pattern = pattern.lstrip("/")
+	body, i = "", 0
+	while i < len(pattern):
+		if pattern.startswith("**/", i):
+			body, i = body + "(?:.*/)?", i + 3
+		elif pattern.startswith("**", i):
+			body, i = body + ".*", i + 2
+		elif pattern[i] == "*":
+			body, i = body + "[^/]*", i + 1
+		elif pattern[i] == "?":
+			body, i = body + "[^/]", i + 1
+		elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+			end = pattern.index("]", i + 1)
+			members = pattern[i + 1:end]
+			body, i = body + "[" + ("^" + members[1:] if members.startswith("!") else members) + "]", end + 1
+		else:
+			body, i = body + re.escape(pattern[i]), i + 1
+	return re.compile(("^" if anchored else "(?:^|.*/)") + body + "$"), negate, dir_only
+
+def path_within(path, prefix):
+	"""
+	Tells whether a path is a prefix directory or lies below it.
+
+	Parameters:
+		path (str): A path relative to the working directory.
+		prefix (str): A directory relative to the working directory.
+
+	Returns:
+		bool: True if path is prefix or inside it.
+	"""
+	path, prefix = os.path.normpath(path), os.path.normpath(prefix)
+	return prefix == "." or path == prefix or path.startswith(prefix.rstrip(os.sep) + os.sep)
+
+def parse_scope(question):
+	"""
+	Splits the @path scopes off a question, e.g. "@services/billing how are invoices retried?".
+
+	Only the @path words the question starts with are scopes, and only if the path exists, so "why is @property used here?" is left alone.
+
+	Parameters:
+		question (str): The question as typed.
+
+	Returns:
+		tuple: The question without its scopes, and the scoped directories relative to the working directory or None if it has none.
+	"""
+	scope, words = [], question.split(None, 1)
+	while words and words[0].startswith("@") and len(words[0]) > 1 and os.path.exists(words[0][1:]):
+		scope.append(os.path.relpath(words[0][1:]))
+		words = words[1].split(None, 1) if len(words) > 1 else []
+	if not scope:
+		return question, None
+	return " ".join(words), scope
+
+class IgnoreMatcher:
+	def __init__(self, root='.', patterns=IGNORE_THESE, use_gitignore=USE_GITIGNORE):
+		"""
+		Initializes a matcher for IGNORE_THESE and the .gitignore files under root.
+
+		IGNORE_THESE is compiled once into a single regex. The rules of every .gitignore are compiled the first time a path below its directory is checked and then reused, deeper files overriding shallower ones as git does. A path is also ignored when one of its parent directories is, so the walker can prune whole subtrees and events under them are dropped.
+
+		Parameters:
+			root (str): (optional) The directory paths are relative to.
+			patterns (list): (optional) The user's ignore patterns.
+			use_gitignore (bool): (optional) Whether .gitignore files are honoured.
+
+		Returns:
+			None
+		"""
+		self.root = os.path.abspath(root)
+		self.use_gitignore = use_gitignore
+		regexes = [rule[0].pattern for rule in map(gitignore_to_regex, patterns) if rule is not None]
+		self._patterns = re.compile("|".join(f"(?:{regex})" for regex in regexes)) if regexes else None
+		self._gitignores = {}  # Directory -> compiled rules of its .gitignore
+		self._directories = {}  # Directory -> whether it is ignored
+		self._lock = threading.Lock()
+
+	def reload(self):
+		"""
+		Forgets the compiled .gitignore rules, e.g. after one of them changed.
+
+		Returns:
+			None
+		"""
+		with self._lock:
+			self._gitignores.clear()
+			self._directories.clear()
+
+	def relative(self, path):
+		"""
+		Converts a path to the "/"-separated form used for matching.
+
+		Parameters:
+			path (str): A path relative to the working directory, or absolute.
+
+		Returns:
+			str: The path relative to root, or None if it is outside of root.
+		"""
+		relative = os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, "/")
+		return None if relative == ".." or relative.startswith("../") else relative
+
+	def is_ignored(self, path, is_dir=False, check_parents=True):
+		"""
+		Determines whether a path should be ignored.
+
+		Parameters:
+			path (str): The path to check.
+			is_dir (bool): (optional) Whether the path is a directory, for patterns ending in "/".
+			check_parents (bool): (optional) Whether ignored parent directories are checked too. The walker turns this off because it never enters them.
+
+		Returns:
+			bool: True if the path should be ignored, False otherwise.
+		"""
+		relative = self.relative(path)
+		if relative is None:
+			return True
+		if relative == ".":
+			return False
+		if check_parents:
+			parts = relative.split("/")
+			for depth in range(1, len(parts)):
+				if self._directory_ignored("/".join(parts[:depth])):
+					return True
+		return self._matches(relative, is_dir)
+
+	def _directory_ignored(self, relative):
+		with self._lock:
+			ignored = self._directories.get(relative)
+		if ignored is None:
+			ignored = self._matches(relative, True)
+			with self._lock:
+				self._directories[relative] = ignored
+		return ignored
+
+	def _matches(self, relative, is_dir):
+		if self._patterns is not None and self._patterns.match(relative):
+			return True
+		if not self.use_gitignore:
+			return False
+		ignored = False
+		directory = ""
+		parts = relative.split("/")
+		for depth in range(len(parts)):
+			for regex, negate, dir_only in self._rules(directory):
+				if (is_dir or not dir_only) and regex.match("/".join(parts[depth:])):
+					ignored = not negate
+			directory = "/".join(parts[:depth + 1])
+		return ignored
+
+	def _rules(self, directory):
+		with self._lock:
+			rules = self._gitignores.get(directory)
+		if rules is None:
+			rules = []
+			try:
+				with open(os.path.join(self.root, directory, ".gitignore"), 'r') as file:
+					rules = [rule for rule in map(gitignore_to_regex, file) if rule is not None]
+			except (OSError, UnicodeDecodeError):
+				pass
+			with self._lock:
+				self._gitignores[directory] = rules
+		return rules
+
+TOMBSTONE = ""  # Docstore id of a deleted entry that is still in an approximate index
+
+def choose_index_type(count, current=None):
+	"""
+	Picks the FAISS index type for a knowledge base.
+
+	Parameters:
+		count (int): The number of chunks in the knowledge base.
+		current (str): (optional) The type of its current index. An approximate index is kept down to ANN_KEEP_CHUNKS chunks.
+
+	Returns:
+		str: "flat", "hnsw" or "ivf".
+	"""
+	if VECTOR_INDEX != "auto":
+		return VECTOR_INDEX
+	return "flat" if count < (ANN_KEEP_CHUNKS if current in ("hnsw", "ivf") else ANN_MIN_CHUNKS) else "hnsw"
+
+def index_type(index):
+	"""
+	Tells the type of a FAISS index.
+
+	Parameters:
+		index (faiss.Index): The index.
+
+	Returns:
+		str: "flat", "hnsw" or "ivf".
+	"""
+	faiss = timed_import("faiss")
+	if isinstance(index, faiss.IndexHNSW):
+		return "hnsw"
+	if isinstance(index, faiss.IndexIVF):
+		return "ivf"
+	return "flat"
+
+def ivf_lists(count):
+	"""
+	Returns the number of IVF lists for a number of vectors, about 4 * sqrt(count) with at least 39 training vectors per list.
+
+	Parameters:
+		count (int): The number of vectors.
+
+	Returns:
+		int: The number of lists.
+	"""
+	return max(1, min(int(4 * math.sqrt(count)), count // 39))
+
+def build_index(kind, vectors):
+	"""
+	Builds a FAISS index of the given type over the given vectors, training it if needed.
+
+	Parameters:
+		kind (str): "flat", "hnsw" or "ivf".
+		vectors (numpy.ndarray): A float32 array of shape (count, dimensions).
+
+	Returns:
+		faiss.Index: The filled index. Positions in the index follow the rows of vectors.
+	"""
+	faiss = timed_import("faiss")
+	dimensions = vectors.shape[1]
+	if kind == "hnsw":
+		index = faiss.IndexHNSWFlat(dimensions, HNSW_M)
+		index.hnsw.efSearch = HNSW_EF_SEARCH
+	elif kind == "ivf":
+		index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dimensions), dimensions, ivf_lists(len(vectors)))
+		index.train(vectors)
+		index.nprobe = IVF_NPROBE
+		index.make_direct_map()  # Lets the index be rebuilt from itself later
+	else:
+		index = faiss.IndexFlatL2(dimensions)
+	index.add(vectors)
+	return index
+
+def tokenize(text):
+	"""
+	Splits text into lowercase search terms.
+
+	Identifiers are kept whole and are also split into their snake_case and camelCase parts, so "update_file_content" matches both itself and "file".
+
+	Parameters:
+		text (str): The text to split.
+
+	Returns:
+		list: The terms of the text, with repetitions.
+	"""
+	terms = []
+	for word in re.findall(r"[A-Za-z_][A-Za-z0-9_]*|\d+", text):
+		terms.append(word.lower())
+		parts = [part.lower() for piece in word.split("_") for part in re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+", piece)]
+		if len(parts) > 1:
+			terms.extend(parts)
+	return terms
+
+class LexicalIndex:
+	def __init__(self, k1=1.5, b=0.75):
+		"""
+		Initializes an in-memory BM25 inverted index over the chunks of the knowledge base.
+
+		Only terms are stored here. The chunk texts stay in the FAISS docstore and are looked up by id.
+
+		Parameters:
+			k1 (float): (optional) BM25 term frequency saturation.
+			b (float): (optional) BM25 length normalization.
+
+		Returns:
+			None
+		"""
+		self.k1 = k1
+		self.b = b
+		self._postings = collections.defaultdict(dict)  # Term -> {chunk id: term frequency}
+		self._lengths = {}  # Chunk id -> number of terms
+		self._counts = {}  # Chunk id -> {term: term frequency}, to remove it again and to save it. Replaced, never changed in place
+		self._total_length = 0
+
+	def add(self, doc_id, text):
+		"""
+		Indexes a chunk.
+
+		Parameters:
+			doc_id (str): The id of the chunk in the knowledge base.
+			text (str): The text of the chunk.
+
+		Returns:
+			None
+		"""
+		self.add_counts(doc_id, collections.Counter(tokenize(text)))
+
+	def add_counts(self, doc_id, counts):
+		"""
+		Indexes a chunk from its term frequencies, e.g. as saved in a snapshot, without tokenizing it again.
+
+		Parameters:
+			doc_id (str): The id of the chunk in the knowledge base.
+			counts (dict): Term -> term frequency, as returned by counts().
+
+		Returns:
+			None
+		"""
+		if doc_id in self._lengths:
+			self.remove(doc_id)
+		counts = dict(counts)
+		for term, count in counts.items():
+			self._postings[term][doc_id] = count
+		self._counts[doc_id] = counts
+		self._lengths[doc_id] = sum(counts.values())
+		self._total_length += self._lengths[doc_id]
+
+	def counts(self, doc_id):
+		"""
+		Returns the term frequencies of a chunk.
+
+		Parameters:
+			doc_id (str): The id of the chunk in the knowledge base.
+
+		Returns:
+			dict: Term -> term frequency, or None if the chunk is not indexed. The dict is never changed afterwards, so it can be saved without holding a lock.
+		"""
+		return self._counts.get(doc_id)
+
+	def remove(self, doc_id):
+		"""
+		Removes a chunk.
+
+		Parameters:
+			doc_id (str): The id of the chunk in the knowledge base.
+
+		Returns:
+			None
+		"""
+		for term in self._counts.pop(doc_id, ()):
+			postings = self._postings[term]
+			postings.pop(doc_id, None)
+			if not postings:
+				del self._postings[term]
+		self._total_length -= self._lengths.pop(doc_id, 0)
+
+	def search(self, query, k=RETRIEVAL_K):
+		"""
+		Ranks the chunks by BM25 score.
+
+		Parameters:
+			query (str): The question.
+			k (int): (optional) The number of ids to return.
+
+		Returns:
+			list: The ids of the best k chunks, best first.
+		"""
+		if not self._lengths:
+			return []
+		average_length = self._total_length / len(self._lengths)
+		scores = collections.defaultdict(float)
+		for term in set(tokenize(query)):
+			postings = self._postings.get(term)
+			if not postings:
+				continue
+			idf = math.log(1 + (len(self._lengths) - len(postings) + 0.5) / (len(postings) + 0.5))
+			for doc_id, count in postings.items():
+				norm = self.k1 * (1 - self.b + self.b * self._lengths[doc_id] / average_length)
+				scores[doc_id] += idf * count * (self.k1 + 1) / (count + norm)
+		return sorted(scores, key=scores.get, reverse=True)[:k]
+
+def fuse_rankings(rankings, k=RETRIEVAL_K, offset=60):
+	"""
+	Merges ranked lists with reciprocal rank fusion.
+
+	Parameters:
+		rankings (list): Lists of keys, best first.
+		k (int): (optional) The number of keys to return.
+		offset (int): (optional) Dampens the weight of the top ranks.
+
+	Returns:
+		list: The best k keys, best first.
+	"""
+	scores = collections.defaultdict(float)
+	for ranking in rankings:
+		for rank, key in enumerate(ranking):
+			scores[key] += 1 / (offset + rank + 1)
+	return sorted(scores, key=scores.get, reverse=True)[:k]
+
+class SymbolIndex:
+	def __init__(self):
+		"""
+		Initializes an index of the definitions and references found in Python files.
+
+		Returns:
+			None
+		"""
+		self._files = {}  # File path -> its extract_symbols result
+		self._definitions = collections.defaultdict(list)  # Name -> [(file path, qualified name, kind, line)]
+		self._references = collections.defaultdict(list)  # Name -> [(file path, line, is_call)]
+
+	def add_file(self, file_path, symbols):
+		"""
+		Indexes the symbols of a file, replacing those it had before.
+
+		Parameters:
+			file_path (str): The path of the file.
+			symbols (dict): The extract_symbols result of the file.
+
+		Returns:
+			None
+		"""
+		self.remove_file(file_path)
+		self._files[file_path] = symbols
+		for name, qualified, kind, line in symbols["definitions"]:
+			self._definitions[name].append((file_path, qualified, kind, line))
+		for name, line, is_call in symbols["references"]:
+			self._references[name].append((file_path, line, is_call))
+
+	def remove_file(self, file_path):
+		"""
+		Removes the symbols of a file.
+
+		Parameters:
+			file_path (str): The path of the file.
+
+		Returns:
+			None
+		"""
+		symbols = self._files.pop(file_path, None)
+		if symbols is None:
+			return
+		for index, names in ((self._definitions, {entry[0] for entry in symbols["definitions"]}), (self._references, {entry[0] for entry in symbols["references"]})):
+			for name in names:
+				entries = [entry for entry in index[name] if entry[0] != file_path]
+				if entries:
+					index[name] = entries
+				else:
+					del index[name]
+
+	def symbols(self, file_path):
+		"""
+		Returns the symbols of a file, as stored in the snapshot.
+
+		Parameters:
+			file_path (str): The path of the file.
+
+		Returns:
+			dict: The extract_symbols result, or None.
+		"""
+		return self._files.get(file_path)
+
+	def definitions(self, name):
+		"""
+		Finds where a name is defined.
+
+		Parameters:
+			name (str): A plain name, or a qualified one such as "FileChangeHandler.search".
+
+		Returns:
+			list: (file path, qualified name, kind, line) entries.
+		"""
+		short = name.rsplit(".", 1)[-1]
+		return [entry for entry in self._definitions.get(short, ()) if "." not in name or entry[1].endswith(name)]
+
+	def references(self, name, calls_only=False):
+		"""
+		Finds where a name is used.
+
+		Parameters:
+			name (str): The name.
+			calls_only (bool): (optional) Whether only calls are returned.
+
+		Returns:
+			list: (file path, line, is_call) entries.
+		"""
+		return [entry for entry in self._references.get(name.rsplit(".", 1)[-1], ()) if entry[2] or not calls_only]
+
+	def answer(self, question, keep=None):
+		"""
+		Answers navigation questions such as "where is X defined" or "who calls X" straight from the index.
+
+		Parameters:
+			question (str): The question.
+			keep (callable): (optional) Called with a file path. Returning False leaves the file out of the answer.
+
+		Returns:
+			str: The answer, or None if the question is not a navigation question about a known symbol.
+		"""
+		text = question.strip().rstrip("?!. ")
+		match = re.search(r"(?:where\s+(?:is|are)\s+|find\s+(?:the\s+)?definition\s+of\s+|go\s+to\s+)`?([A-Za-z_][\w.]*)`?(?:\s+(defined|declared|implemented))?$", text, re.IGNORECASE)
+		if match and (match.group(2) or not text.lower().startswith("where")):
+			entries = [entry for entry in self.definitions(match.group(1)) if keep is None or keep(entry[0])]
+			if not entries:
+				return None
+			lines = [f"  {path}:{line}  {kind} {qualified}" for path, qualified, kind, line in entries[:20]]
+			return f"`{match.group(1)}` is defined in:\n" + "\n".join(lines)
+		match = re.search(r"(?:(?:who|what|where)\s+(?:calls|uses|references)\s+|callers\s+of\s+|usages?\s+of\s+|where\s+is\s+)`?([A-Za-z_][\w.]*)`?(?:\s+(used|called|referenced))?$", text, re.IGNORECASE)
+		if match and (match.group(2) or not text.lower().startswith("where is")):
+			calls_only = "call" in text.lower()
+			entries = [entry for entry in self.references(match.group(1), calls_only=calls_only) if keep is None or keep(entry[0])]
+			if not entries:
+				return None
+			by_file = collections.defaultdict(list)
+			for path, line, _ in entries:
+				by_file[path].append(str(line))
+			lines = [f"  {path}: lines {', '.join(numbers[:20])}" for path, numbers in sorted(by_file.items())]
+			return f"`{match.group(1)}` is {'called' if calls_only else 'used'} in:\n" + "\n".join(lines)
+		return None
+
+	def mentioned_definitions(self, question, limit=2):
+		"""
+		Finds the definitions of the identifiers a question mentions.
+
+		Parameters:
+			question (str): The question.
+			limit (int): (optional) The maximum number of definitions to return.
+
+		Returns:
+			list: (file path, qualified name, kind, line) entries.
+		"""
+		found = []
+		for name in re.findall(r"[A-Za-z_][\w.]*", question):
+			# Plain words are too ambiguous, only identifier-looking names count
+			if "_" not in name and "." not in name and not re.search(r"[a-z][A-Z]", name) and "`" + name + "`" not in question:
+				continue
+			for entry in self.definitions(name):
+				if entry not in found:
+					found.append(entry)
+		return found[:limit]
+
+class FileChangeHandler:
+	def __init__(self, ignore_list=IGNORE_THESE, root='.', nested_roots=(), answer_cache=None, embeddings=None):
+		"""
+		Initializes the object with an optional ignore list.
+
+		Parameters:
+		    ignore_list (list): The patterns to ignore, relative to root. Defaults to IGNORE_THESE.
+		    root (str): (optional) The directory this handler indexes and watches.
+		    nested_roots (list): (optional) Roots below root that have their own handler and are skipped here.
+		    answer_cache (AnswerCache): (optional) The answer cache, shared between the handlers of all roots.
+		    embeddings (Embeddings): (optional) The embeddings used for chunks. Defaults to build_embeddings().
+
+		Returns:
+		    None
+		"""
+		self.ignore_list = ignore_list  # Ignore list
+		self.root = os.path.relpath(root)
+		self.nested_roots = [os.path.relpath(path) for path in nested_roots]
+		self.matcher = IgnoreMatcher(root=self.root, patterns=self.ignore_list)
+		self.data = {}
+		self.knowledge_base = None
+		self.file_chunk_ids = {}  # File path -> ids of its chunks in the knowledge base
+		self.file_hashes = {}  # File path -> hash of the content its chunks were built from
+		self.lexical_index = LexicalIndex()
+		self.symbol_index = SymbolIndex()
+		self.tombstones = set()  # Positions of deleted entries still in an approximate index
+		self._positions = None  # Docstore id -> index position, built on demand for approximate indexes
+		self.lock = threading.RLock()  # Guards the knowledge base between the observer and input threads
+		self.write_lock = threading.RLock()  # Serializes changes to the knowledge base, so a rebuild can read the index without self.lock
+		self.unsaved_since = None  # Monotonic time of the first change not in the snapshot yet
+		self._snapshot_lock = threading.Lock()  # Keeps two saves from writing the snapshot files at once
+		self.snapshot_dir = os.path.join(CACHE_DIR, "shards", os.path.basename(os.path.abspath(self.root)) + "_" + hashlib.sha256(os.path.abspath(self.root).encode()).hexdigest()[:8])
+		self.embeddings = embeddings if embeddings is not None else build_embeddings()
+		self.model_id = embedding_id(embeddings if embeddings is not None else default_embedder())
+		self.answer_cache = answer_cache if answer_cache is not None else AnswerCache()
+		self.reindex_worker = ReindexWorker(self)
+	def dispatch(self, event):
+		"""
+		Routes a watchdog event to the on_<event type> method, as watchdog's FileSystemEventHandler does, without importing watchdog.
+
+		:param event: The watchdog event.
+		"""
+		handler = getattr(self, f"on_{event.event_type}", None)
+		if handler is not None:
+			handler(event)
+
+	def should_ignore(self, filename):
+		"""
+		Determines whether a given filename should be ignored.
+
+		Parameters:
+			filename (str): The name of the file to be checked.
+
+		Returns:
+			bool: True if the filename should be ignored, False otherwise.
+		"""
+		return self.matcher.is_ignored(filename) or any(path_within(os.path.relpath(filename), root) for root in self.nested_roots)
+
+	def overlaps(self, scope):
+		"""
+		Tells whether any file of this root can lie under one of the scoped directories.
+
+		Parameters:
+			scope (list): Directories relative to the working directory, or None for everything.
+
+		Returns:
+			bool: True if the root has to be searched for the scope.
+		"""
+		if scope is None:
+			return True
+		return any(
+			path_within(self.root, prefix) or (path_within(prefix, self.root) and not any(path_within(prefix, root) for root in self.nested_roots))
+			for prefix in scope
+		)
+
+	def on_modified(self, event):
+		"""
+		Handles the on_modified event.
+
+		:param event: The event object containing information about the modified file.
+		"""
+		if event.is_directory or ".mp3" in event.src_path:
+			return
+		self.check_gitignore(event.src_path)
+		if not self.should_ignore(event.src_path):
+			print(f'\n\U0001F4BE The file {event.src_path} has changed!')
+			self.reindex_worker.submit(event.src_path)
+
+	def check_gitignore(self, file_path):
+		"""
+		Reloads the ignore rules and queues a rescan of the directory when a .gitignore was changed, created, deleted or moved.
+
+		Parameters:
+			file_path (str): The path of the file the event is about.
+
+		Returns:
+			None
+		"""
+		if os.path.basename(file_path) == ".gitignore":
+			# The rules changed for the whole directory, rescan it to drop what is now ignored and pick up what no longer is
+			self.matcher.reload()
+			self.reindex_worker.submit(os.path.dirname(file_path) or ".")
+
+	def on_created(self, event):
+		"""
+		Handles the on_created event by indexing the new file.
+
+		:param event: The event object containing information about the created file.
+		"""
+		self.on_modified(event)
+
+	def on_deleted(self, event):
+		"""
+		Handles the on_deleted event by dropping the file's chunks from the knowledge base.
+
+		:param event: The event object containing information about the deleted file.
+		"""
+		if event.is_directory:
+			return
+		self.check_gitignore(event.src_path)
+		if self.should_ignore(event.src_path):
+			return
+		print(f'\n\U0001F5D1 The file {event.src_path} was deleted!')
+		self.reindex_worker.submit(event.src_path)
+
+	def on_moved(self, event):
+		"""
+		Handles the on_moved event by re-indexing the file under its new path.
+
+		:param event: The event object containing information about the moved file.
+		"""
+		if event.is_directory:
+			return
+		self.check_gitignore(event.src_path)
+		self.check_gitignore(event.dest_path)
+		if not self.should_ignore(event.src_path):
+			self.reindex_worker.submit(event.src_path)
+		if not self.should_ignore(event.dest_path):
+			self.reindex_worker.submit(event.dest_path)
+
+	def collect_files(self, directory=None):
+		"""
+		Walks the root directory and yields the path of every file that is not ignored.
+
+		Parameters:
+			directory (str): (optional) A directory below the root to walk instead of all of it.
+
+		Returns:
+			generator: File paths relative to the current directory.
+		"""
+		# The walk is timed without the time the consumer spends between two paths
+		spent, found, started = 0.0, 0, time.perf_counter()
+		for root, dirs, files in os.walk(directory or self.root):
+			# Prune ignored directories and the roots of other shards so their subtrees are never walked
+			dirs[:] = [
+				d for d in dirs
+				if not self.matcher.is_ignored(os.path.join(root, d), is_dir=True, check_parents=False)
+				and os.path.relpath(os.path.join(root, d)) not in self.nested_roots
+			]
+			for filename in files:
+				file_path = os.path.join(root, filename)
+				if not self.matcher.is_ignored(file_path, check_parents=False):
+					spent, found = spent + time.perf_counter() - started, found + 1
+					yield os.path.relpath(file_path)
+					started = time.perf_counter()
+		metrics.observe("walk", spent + time.perf_counter() - started, items=found)
+
+	def collect_files_seen(self, seen):
+		"""
+		Yields the same paths as collect_files while recording them.
+
+		Parameters:
+			seen (set): The set every yielded path is added to.
+
+		Returns:
+			generator: File paths relative to the current directory.
+		"""
+		for file_path in self.collect_files():
+			seen.add(file_path)
+			yield file_path
+
+	def embed_files(self, file_chunks):
+		"""
+		Embeds the chunks of one or more files without touching the knowledge base, so it can run without holding the lock.
+
+		Parameters:
+			file_chunks (dict): A mapping of file path to its chunk_file pairs.
+
+		Returns:
+			list: (text, embedding) pairs of every chunk, in the order of file_chunks.
+		"""
+		texts = [chunk_text for chunks in file_chunks.values() for chunk_text, _ in chunks]
+		if not texts:
+			return []
+		return list(zip(texts, embed_texts(self.embeddings, texts)))
+
+	def tree_files(self, directory):
+		"""
+		Lists the files a rescan of a directory has to re-index: the ones indexed under it and the ones now found under it.
+
+		Parameters:
+			directory (str): A directory below the root.
+
+		Returns:
+			list: File paths relative to the current directory.
+		"""
+		with self.lock:
+			indexed = [path for path in self.file_chunk_ids if path_within(path, directory)]
+		found = [] if self.should_ignore(directory) else list(self.collect_files(directory))
+		return list(dict.fromkeys(indexed + found))
+
+	def add_files(self, file_chunks, text_embeddings):
+		"""
+		Adds the embedded chunks of one or more files to the knowledge base.
+
+		Parameters:
+			file_chunks (dict): A mapping of file path to its chunk_file pairs.
+			text_embeddings (list): The embed_files result for file_chunks.
+
+		Returns:
+			None
+		"""
+		metadatas, ids = [], []
+		for file_path, chunks in file_chunks.items():
+			if not chunks:
+				continue
+			file_ids = [f"{file_path}#{i}" for i in range(len(chunks))]
+			metadatas.extend(metadata for _, metadata in chunks)
+			ids.extend(file_ids)
+			self.file_chunk_ids[file_path] = file_ids
+		if not ids:
+			return
+		with metrics.measure("index_build", items=len(ids)):
+			for doc_id, (text, _) in zip(ids, text_embeddings):
+				self.lexical_index.add(doc_id, text)
+			if self.knowledge_base is None:
+				self.knowledge_base = timed_import("langchain.vectorstores").FAISS.from_embeddings(text_embeddings, self.embeddings, metadatas=metadatas, ids=ids)
+				self._positions = None
+			else:
+				start = len(self.knowledge_base.index_to_docstore_id)
+				self.knowledge_base.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+				if self._positions is not None:
+					self._positions.update((doc_id, start + i) for i, doc_id in enumerate(ids))
+
+	def remove_file(self, file_path):
+		"""
+		Removes every chunk of a file from the knowledge base.
+
+		Parameters:
+			file_path (str): The path of the file to remove.
+
+		Returns:
+			None
+		"""
+		ids = self.file_chunk_ids.pop(file_path, None)
+		self.file_hashes.pop(file_path, None)
+		self.symbol_index.remove_file(file_path)
+		self.answer_cache.invalidate_file(file_path)
+		for doc_id in ids or ():
+			self.lexical_index.remove(doc_id)
+		if not ids or self.knowledge_base is None:
+			return
+		if index_type(self.knowledge_base.index) == "flat":
+			self.knowledge_base.delete(ids)
+			self._positions = None  # The flat index renumbers its entries
+			return
+		# Approximate indexes cannot drop entries cheaply, so the entries stay behind as tombstones until the next rebuild
+		if self._positions is None:
+			self._positions = {doc_id: position for position, doc_id in self.knowledge_base.index_to_docstore_id.items() if doc_id != TOMBSTONE}
+		for doc_id in ids:
+			position = self._positions.pop(doc_id, None)
+			if position is not None:
+				self.knowledge_base.index_to_docstore_id[position] = TOMBSTONE
+				self.tombstones.add(position)
+		self.knowledge_base.docstore.delete(ids)
+
+	def optimize_index(self):
+		"""
+		Rebuilds the vector index when its type no longer suits the size of the knowledge base.
+
+		The index is rebuilt from its own vectors, so nothing is embedded again, when:
+		- the type chosen by choose_index_type changed
+		- more than TOMBSTONE_RATIO of an approximate index are deleted entries
+		- an IVF index has grown well past the size it was trained for
+
+		Only write_lock is held while the new index is built, which keeps changes out but lets questions search the old index. The new index is swapped in under the lock.
+
+		Returns:
+			None
+		"""
+		with self.write_lock:
+			knowledge_base = self.knowledge_base
+			if knowledge_base is None or knowledge_base.index.ntotal == 0:
+				return
+			index = knowledge_base.index
+			# Decided from the counts alone, the live entries are only listed when the index is actually rebuilt
+			count = index.ntotal - len(self.tombstones)
+			current = index_type(index)
+			target = choose_index_type(count, current)
+			retrain = current == "ivf" and ivf_lists(count) > 2 * index.nlist
+			if current == target and not retrain and len(self.tombstones) <= TOMBSTONE_RATIO * index.ntotal:
+				return
+			live = [(position, doc_id) for position, doc_id in sorted(knowledge_base.index_to_docstore_id.items()) if doc_id != TOMBSTONE]
+			print(f"\U0001F6E0 Rebuilding the {current} index as {target} over {len(live)} chunks...")
+			with metrics.measure("index_rebuild", items=len(live)):
+				vectors = index.reconstruct_n(0, index.ntotal)
+				if len(live) < index.ntotal:
+					vectors = vectors[[position for position, _ in live]]
+				rebuilt = build_index(target, np.ascontiguousarray(vectors, dtype=np.float32))
+				del vectors
+			with self.lock:
+				knowledge_base.index = rebuilt
+				knowledge_base.index_to_docstore_id = {position: doc_id for position, (_, doc_id) in enumerate(live)}
+				self.tombstones = set()
+				self._positions = None
+
+	def vector_search(self, query_embedding, k, keep=None):
+		"""
+		Finds the chunks closest to an embedding.
+
+		Searches the FAISS index directly rather than through the vector store, so deleted entries still present in an approximate index can be skipped.
+
+		Parameters:
+			query_embedding (list): The embedding of the question.
+			k (int): The number of chunks to return.
+			keep (callable): (optional) Called with a file path. Returning False skips the chunks of the file.
+
+		Returns:
+			list: The closest Documents, best first.
+		"""
+		knowledge_base = self.knowledge_base
+		fetch = min((k if keep is None else k * 4) + min(len(self.tombstones), k * 4), knowledge_base.index.ntotal)
+		if fetch == 0:
+			return []
+		_, positions = knowledge_base.index.search(np.array([query_embedding], dtype=np.float32), fetch)
+		ids = [knowledge_base.index_to_docstore_id.get(int(position)) for position in positions[0] if position != -1]
+		docs = [doc for _, doc in self.documents([doc_id for doc_id in ids if doc_id])]
+		return [doc for doc in docs if keep is None or keep(doc.metadata.get("source"))][:k]
+
+	def replace_files(self, file_chunks, file_hashes, file_symbols=None):
+		"""
+		Replaces the chunks of the given files in the knowledge base.
+
+		The new chunks are embedded before the lock is taken, so questions are answered meanwhile, and the old chunks are only swapped out once embedding succeeded, so a failed embedding call leaves the files as they were indexed before.
+
+		Parameters:
+			file_chunks (dict): File path -> its new chunk_file pairs. An empty list removes the file.
+			file_hashes (dict): File path -> hash of the content the chunks were built from.
+			file_symbols (dict): (optional) File path -> its extract_symbols result, for Python files.
+
+		Returns:
+			None
+		"""
+		text_embeddings = self.embed_files(file_chunks)
+		with self.write_lock, self.lock:
+			for file_path in file_chunks:
+				self.remove_file(file_path)
+			self.add_files(file_chunks, text_embeddings)
+			self.file_hashes.update({path: file_hashes[path] for path, chunks in file_chunks.items() if chunks})
+			for file_path, symbols in (file_symbols or {}).items():
+				if symbols is not None and file_chunks.get(file_path):
+					self.symbol_index.add_file(file_path, symbols)
+
+	def load_snapshot(self):
+		"""
+		Loads the knowledge base snapshot saved by a previous run, if there is one for the current embedding model.
+
+		Returns:
+			bool: True if a snapshot was loaded, False otherwise.
 		"""
-		Initializes the object with an optional ignore list.
+		manifest_path = os.path.join(self.snapshot_dir, "manifest.json")
+		try:
+			with open(manifest_path, 'r') as file:
+				manifest = json.load(file)
+			if manifest.get("version") != SNAPSHOT_VERSION or manifest.get("model") != self.model_id or manifest.get("chunking") != [CHUNK_SIZE, CHUNK_OVERLAP]:
+				return False
+			if manifest["files"]:
+				faiss = timed_import("faiss")
+				# The docstore is plain JSON rather than a pickle, so a snapshot found in a cloned tree cannot run code
+				with open(os.path.join(self.snapshot_dir, "docstore.json"), 'r') as file:
+					store = json.load(file)
+				index = faiss.read_index(os.path.join(self.snapshot_dir, "index.faiss"))
+				if index.ntotal != len(store["ids"]):
+					return False
+				Document = timed_import("langchain.docstore.document").Document
+				docstore = timed_import("langchain.docstore.in_memory").InMemoryDocstore(
+					{doc_id: Document(page_content=text, metadata=metadata) for doc_id, (text, metadata) in store["documents"].items()}
+				)
+				knowledge_base = timed_import("langchain.vectorstores").FAISS(self.embeddings, index, docstore, dict(enumerate(store["ids"])))
+			else:
+				knowledge_base = None
+		except Exception as e:
+			return False
+		self.knowledge_base = knowledge_base
+		self.file_chunk_ids = {path: entry["ids"] for path, entry in manifest["files"].items()}
+		self.file_hashes = {path: entry["hash"] for path, entry in manifest["files"].items()}
+		self.tombstones = {position for position, doc_id in knowledge_base.index_to_docstore_id.items() if doc_id == TOMBSTONE} if knowledge_base else set()
+		self._positions = None
+		self.symbol_index = SymbolIndex()
+		for path, entry in manifest["files"].items():
+			if entry.get("symbols") is not None:
+				self.symbol_index.add_file(path, entry["symbols"])
+		# The term frequencies are saved with the files, so restarting never tokenizes the chunks again
+		self.lexical_index = LexicalIndex()
+		for entry in manifest["files"].values():
+			for doc_id, counts in zip(entry["ids"], entry["terms"]):
+				self.lexical_index.add_counts(doc_id, counts)
+		return True
+
+	def documents(self, ids):
+		"""
+		Looks chunks up in the docstore of the knowledge base.
+
+		Parameters:
+			ids (list): The ids of the chunks.
+
+		Returns:
+			list: (id, Document) pairs for the ids that were found.
+		"""
+		if self.knowledge_base is None:
+			return []
+		found = []
+		for doc_id in ids:
+			doc = self.knowledge_base.docstore.search(doc_id)
+			if not isinstance(doc, str):  # The docstore returns an error message for unknown ids
+				found.append((doc_id, doc))
+		return found
+
+	def search(self, question, query_embedding, k=RETRIEVAL_K, scope=None):
+		"""
+		Retrieves the chunks most relevant to a question, recording the time it took in metrics.
+
+		The chunks defining the identifiers the question mentions come first. They are followed by the vector hits, fused with BM25 keyword hits when HYBRID_SEARCH is on, which finds exact identifiers and error strings that embeddings tend to miss.
+
+		Parameters:
+			question (str): The question.
+			query_embedding (list): The embedding of the question.
+			k (int): (optional) The number of chunks to return.
+			scope (list): (optional) Only chunks of files under these directories are returned.
+
+		Returns:
+			list: The best k Documents, best first.
+		"""
+		with metrics.measure("search"):
+			return self._search(question, query_embedding, k, scope)
+
+	def _search(self, question, query_embedding, k, scope):
+		keep = self.scope_filter(scope)
+		with self.lock:
+			if self.knowledge_base is None:
+				return []
+			definition_docs = [doc for doc in self.definition_documents(question) if keep is None or keep(doc.metadata.get("source"))]
+			vector_docs = self.vector_search(query_embedding, k * 2 if HYBRID_SEARCH else k, keep)
+			lexical_ids = self.lexical_index.search(question, k * 2 if keep is None else k * 8) if HYBRID_SEARCH else []
+			lexical_docs = [doc for _, doc in self.documents(lexical_ids) if keep is None or keep(doc.metadata.get("source"))][:k * 2]
+		docs = {}
+		rankings = []
+		for ranked in (definition_docs, vector_docs, lexical_docs):
+			keys = []
+			for doc in ranked:
+				key = (doc.metadata.get("source"), doc.metadata.get("start_line"), doc.metadata.get("end_line"))
+				docs.setdefault(key, doc)
+				keys.append(key)
+			rankings.append(keys)
+		ranked = fuse_rankings(rankings[1:], len(docs)) if HYBRID_SEARCH else rankings[1]
+		keys = list(dict.fromkeys(rankings[0] + ranked))
+		return [docs[key] for key in keys[:max(k, len(rankings[0]))]]
+
+	def scope_filter(self, scope):
+		"""
+		Builds the file filter for a scope.
+
+		Parameters:
+			scope (list): Directories relative to the working directory, or None for everything.
+
+		Returns:
+			callable: Called with a file path, returns whether the file is in scope. None when every file of this root is.
+		"""
+		if scope is None or any(path_within(self.root, prefix) for prefix in scope):
+			return None
+		return lambda file_path: file_path is not None and any(path_within(file_path, prefix) for prefix in scope)
+
+	def definition_documents(self, question):
+		"""
+		Finds the chunks that define the identifiers a question mentions.
+
+		Parameters:
+			question (str): The question.
+
+		Returns:
+			list: The Documents holding the definitions.
+		"""
+		docs = []
+		for file_path, _, _, line in self.symbol_index.mentioned_definitions(question):
+			for _, doc in self.documents(self.file_chunk_ids.get(file_path, ())):
+				if doc.metadata.get("start_line", 0) <= line <= doc.metadata.get("end_line", 0):
+					docs.append(doc)
+					break
+		return docs
+
+	def save_snapshot(self):
+		"""
+		Saves the knowledge base and the per-file manifest under CACHE_DIR so the next run can skip unchanged files.
+
+		Only copying the index and the chunks out of the knowledge base holds the lock, the files are written after it is released. The vectors are written by FAISS and everything else as JSON.
+
+		Returns:
+			None
+		"""
+		with self._snapshot_lock:
+			with self.lock:
+				self.unsaved_since = None
+				index, doc_ids, documents = None, [], {}
+				if self.knowledge_base is not None:
+					faiss = timed_import("faiss")
+					index = faiss.serialize_index(self.knowledge_base.index)
+					positions = self.knowledge_base.index_to_docstore_id
+					doc_ids = [positions.get(position, TOMBSTONE) for position in range(self.knowledge_base.index.ntotal)]
+					documents = {doc_id: [doc.page_content, doc.metadata] for doc_id, doc in self.documents([doc_id for doc_id in doc_ids if doc_id != TOMBSTONE])}
+				manifest = {
+					"version": SNAPSHOT_VERSION,
+					"model": self.model_id,
+					"chunking": [CHUNK_SIZE, CHUNK_OVERLAP],
+					"files": {
+						path: {
+							"hash": self.file_hashes.get(path),
+							"ids": ids,
+							"symbols": self.symbol_index.symbols(path),
+							"terms": [self.lexical_index.counts(doc_id) or {} for doc_id in ids],
+						}
+						for path, ids in self.file_chunk_ids.items()
+					},
+				}
+			os.makedirs(self.snapshot_dir, exist_ok=True)
+			written = []
+			if index is not None:
+				with open(os.path.join(self.snapshot_dir, "index.faiss.tmp"), 'wb') as file:
+					file.write(index.tobytes())
+				with open(os.path.join(self.snapshot_dir, "docstore.json.tmp"), 'w') as file:
+					json.dump({"ids": doc_ids, "documents": documents}, file)
+				written = ["index.faiss", "docstore.json"]
+			with open(os.path.join(self.snapshot_dir, "manifest.json.tmp"), 'w') as file:
+				json.dump(manifest, file)
+			# The manifest goes last, it is what makes the other files count
+			for name in written + ["manifest.json"]:
+				os.replace(os.path.join(self.snapshot_dir, name + ".tmp"), os.path.join(self.snapshot_dir, name))
+
+	def update_files(self, file_paths, is_superseded=None, announce=True):
+		"""
+		Re-indexes the given files.
+
+		Only the chunks of the given files are deleted from the knowledge base and only their new chunks are embedded, so a save costs a handful of embedding calls instead of a full rebuild. A file that no longer exists or is now ignored is simply removed, and a directory is rescanned with tree_files. The snapshot is not saved here, the re-index worker saves it SNAPSHOT_INTERVAL seconds later.
+
+		Parameters:
+			file_paths (list): The paths of the changed files or directories.
+			is_superseded (callable): (optional) Called with a path before it is read. Returning True skips the file because a newer change to it is already queued.
+			announce (bool): (optional) Whether to print and speak that the files were re-indexed.
+
+		Returns:
+			None
+		"""
+		file_chunks, file_hashes, file_symbols = {}, {}, {}
+		file_paths = [path for file_path in file_paths for path in (self.tree_files(file_path) if os.path.isdir(file_path) else [file_path])]
+		for file_path in map(os.path.relpath, file_paths):
+			if is_superseded is not None and is_superseded(file_path):
+				continue
+			if self.should_ignore(file_path):
+				if file_path in self.file_chunk_ids:
+					file_chunks[file_path], file_hashes[file_path], file_symbols[file_path] = [], None, None
+				continue
+			file_path, file_hash, chunks, symbols = load_file(file_path, self.file_hashes.get(file_path))
+			if chunks is None:
+				continue  # Saved without changes
+			file_chunks[file_path], file_hashes[file_path], file_symbols[file_path] = chunks, file_hash, symbols
+		if not file_chunks:
+			return
+		self.replace_files(file_chunks, file_hashes, file_symbols)
+		self.optimize_index()
+		with self.lock:
+			if self.unsaved_since is None:
+				self.unsaved_since = time.monotonic()
+		if announce:
+			print(f"\U00002705 Re-indexed {len(file_chunks)} files ({sum(len(chunks) for chunks in file_chunks.values())} chunks). All set!")
+			speak_phrase("Files updated. Ready for questions")
+
+	def update_file_content(self, announce=True):
+		"""
+		Update the content of files in the root directory.
+
+		This function collects all the files in the root directory and its subdirectories and brings the knowledge base up to date. It performs the following steps:
+
+		1. Checks if ".env" files (".env", ".env.local", "local.env", ...) are ignored. If they are not, it prompts a warning message asking for confirmation to include the ".env" file. If the user does not confirm, the function exits.
+		2. Loads the knowledge base snapshot of the previous run from CACHE_DIR, if there is one.
+		3. Iterates over all the files in the root directory and its subdirectories, excluding the roots of other shards, the directories in the ignore list and the files in the ignore list.
+		4. Reads the files on INGEST_WORKERS processes. Every file whose content hash matches the snapshot is skipped. Every other file is split into chunks with chunk_file, along function and class boundaries for Python and along lines otherwise.
+		5. Streams the chunks into the knowledge base in batches of INDEX_BATCH_SIZE chunks, replacing the old chunks of each changed file. Chunks whose text was embedded before are served from the embedding cache.
+		6. Removes the chunks of deleted files.
+		7. Saves the snapshot, prints a success message and plays an audio indicating that the files have been updated and the function is ready for questions.
+
+		Note: Make sure ".env*" and "*.env" stay in the ignore list to prevent exposing sensitive information to OpenAI.
+
+		Parameters:
+		- self: The current instance of the class.
+		- announce: Whether to print and speak that the knowledge base is ready.
+
+		Return:
+		- None
+		"""
+		print(f"\n\U0001F4C1 Collecting files in {self.root}...")
+		# Check if env files are ignored, if not prompt warning "Are you sure you want to include your .env in your api call to OpenAI?"
+		if not all(self.matcher.is_ignored(os.path.join(self.root, name)) for name in (".env", ".env.local", "local.env")):
+			response = input("😨 You removed .env from ignore list. This may expose .env variables to OpenAI. Confirm? (1 for Yes, 2 for exit):")
+			if response != "1":
+				print("\n😅 Phew. Close one... Operation aborted. Please add '.env*' and '*.env' to your ignore list and try again.")
+				exit()
+		with self.write_lock, self.lock:
+			if self.load_snapshot():
+				print(f"\U0001F4BE Loaded snapshot with {len(self.file_chunk_ids)} files")
+			else:
+				self.knowledge_base, self.file_chunk_ids, self.file_hashes = None, {}, {}
+				self.tombstones, self._positions = set(), None
+				self.lexical_index = LexicalIndex()
+				self.symbol_index = SymbolIndex()
+			known_hashes = dict(self.file_hashes)
+
+		seen, updated = set(), 0
+		batch, batch_hashes, batch_symbols, batch_size = {}, {}, {}, 0
+		for file_path, file_hash, chunks, symbols in ingest_files(self.collect_files_seen(seen), known_hashes):
+			if chunks is None:
+				continue
+			batch[file_path], batch_hashes[file_path], batch_symbols[file_path] = chunks, file_hash, symbols
+			batch_size += len(chunks)
+			if batch_size >= INDEX_BATCH_SIZE:
+				self.replace_files(batch, batch_hashes, batch_symbols)
+				updated += len(batch)
+				batch, batch_hashes, batch_symbols, batch_size = {}, {}, {}, 0
+		self.replace_files(batch, batch_hashes, batch_symbols)
+		updated += len(batch)
+
+		with self.write_lock, self.lock:
+			# Drop the files that were deleted since the snapshot
+			for file_path in [path for path in self.file_chunk_ids if path not in seen]:
+				self.remove_file(file_path)
+		self.optimize_index()
+		self.save_snapshot()
+		print(f"\U0001F504 {updated} files (re)indexed, {len(self.file_chunk_ids)} files in the knowledge base of {self.root}")
+		if self.knowledge_base is not None:
+			print(f"\U0001F5C2 {index_type(self.knowledge_base.index)} index of {self.knowledge_base.index.ntotal} vectors")
+		if announce:
+			print("\U00002705 All set!")
+			speak_phrase("Files updated. Ready for questions")
+
+class ShardedKnowledgeBase:
+	def __init__(self, roots=ROOTS, ignore_list=IGNORE_THESE, embeddings=None):
+		"""
+		Initializes one knowledge base shard per root.
+
+		Every shard has its own index, snapshot and re-index worker, so a change under one root only rebuilds that shard, and a question scoped with @path only searches the shards that can hold files under path. A root nested in another one is left out of the outer shard.
+
+		Parameters:
+			roots (list): (optional) The directories to index.
+			ignore_list (list): (optional) The ignore patterns, applied relative to each root.
+			embeddings (Embeddings): (optional) The embeddings used for chunks. Defaults to build_embeddings().
+
+		Returns:
+			None
+		"""
+		roots = list(dict.fromkeys(os.path.relpath(root) for root in roots))
+		self.answer_cache = AnswerCache()
+		self.shards = [
+			FileChangeHandler(
+				ignore_list=ignore_list,
+				root=root,
+				nested_roots=[other for other in roots if other != root and path_within(other, root)],
+				answer_cache=self.answer_cache,
+				embeddings=embeddings,
+			)
+			for root in roots
+		]
+
+	def update_file_content(self):
+		"""
+		Brings every shard up to date with its root.
+
+		Returns:
+			None
+		"""
+		for i, shard in enumerate(self.shards):
+			shard.update_file_content(announce=i == len(self.shards) - 1)
+
+	def watch(self, observer):
+		"""
+		Schedules every shard on an observer and starts their re-index workers.
+
+		Parameters:
+			observer (Observer): The watchdog observer.
+
+		Returns:
+			None
+		"""
+		for shard in self.shards:
+			observer.schedule(shard, path=shard.root, recursive=True)
+			shard.reindex_worker.start()
+
+	def stop(self):
+		"""
+		Stops the re-index workers of every shard, waiting for them to save the changes not in the snapshots yet.
+
+		Returns:
+			None
+		"""
+		for shard in self.shards:
+			shard.reindex_worker.stop()
+		for shard in self.shards:
+			if shard.reindex_worker.is_alive():
+				shard.reindex_worker.join()
+
+	def select(self, scope=None):
+		"""
+		Returns the shards a scope touches.
+
+		Parameters:
+			scope (list): (optional) Directories relative to the working directory, or None for everything.
+
+		Returns:
+			list: The FileChangeHandlers of the shards.
+		"""
+		return [shard for shard in self.shards if shard.overlaps(scope)]
+
+	def is_empty(self, scope=None):
+		"""
+		Tells whether no shard of a scope has anything indexed.
+
+		Parameters:
+			scope (list): (optional) Directories relative to the working directory, or None for everything.
+
+		Returns:
+			bool: True if there is nothing to search.
+		"""
+		return all(shard.knowledge_base is None for shard in self.select(scope))
+
+	def navigate(self, question, scope=None):
+		"""
+		Answers a navigation question from the symbol indexes of the shards of a scope.
+
+		Parameters:
+			question (str): The question.
+			scope (list): (optional) Directories relative to the working directory, or None for everything.
+
+		Returns:
+			str: The answer, or None if the question is not a navigation question about a known symbol.
+		"""
+		answers = []
+		for shard in self.select(scope):
+			with shard.lock:
+				answer = shard.symbol_index.answer(question, keep=shard.scope_filter(scope))
+			if answer is not None:
+				answers.append(answer.splitlines())
+		if not answers:
+			return None
+		# Every shard words the first line the same way, only the locations differ
+		return "\n".join(answers[0][:1] + [line for answer in answers for line in answer[1:]])
+
+	def search(self, question, query_embedding, k=RETRIEVAL_K, scope=None):
+		"""
+		Retrieves the chunks most relevant to a question from the shards of a scope.
+
+		Parameters:
+			question (str): The question.
+			query_embedding (list): The embedding of the question.
+			k (int): (optional) The number of chunks to return.
+			scope (list): (optional) Only chunks of files under these directories are returned.
+
+		Returns:
+			list: The best k Documents, best first.
+		"""
+		results = [shard.search(question, query_embedding, k, scope) for shard in self.select(scope)]
+		results = [docs for docs in results if docs]
+		if len(results) <= 1:
+			return results[0] if results else []
+		docs = {}
+		rankings = []
+		for ranked in results:
+			rankings.append([id(doc) for doc in ranked])
+			docs.update((id(doc), doc) for doc in ranked)
+		return [docs[key] for key in fuse_rankings(rankings, k)]
+
+class ReindexWorker(threading.Thread):
+	def __init__(self, handler, quiet_window=REINDEX_QUIET_WINDOW, snapshot_interval=SNAPSHOT_INTERVAL):
+		"""
+		Initializes the worker that re-indexes changed files in the background.
+
+		Events are coalesced per path: a path is only re-indexed once no new event for it has arrived for quiet_window seconds, so a burst of saves (a git checkout, a formatter run) costs one pass instead of one per event. The snapshot is saved snapshot_interval seconds after the first re-index it does not hold yet, and once more when the worker stops.
+
+		Parameters:
+			handler (FileChangeHandler): The handler whose knowledge base is updated.
+			quiet_window (float): Seconds a path must stay quiet before it is re-indexed.
+			snapshot_interval (float): Seconds a re-index may stay out of the snapshot.
+
+		Returns:
+			None
+		"""
+		super().__init__(daemon=True)
+		self.handler = handler
+		self.quiet_window = quiet_window
+		self.snapshot_interval = snapshot_interval
+		self._pending = {}  # Path -> time of its latest event
+		self._condition = threading.Condition()
+		self._stopped = False
+
+	def submit(self, file_path):
+		"""
+		Queues a changed path, restarting its quiet window.
+
+		Parameters:
+			file_path (str): The path of the changed file.
+
+		Returns:
+			None
+		"""
+		with self._condition:
+			self._pending[os.path.relpath(file_path)] = time.monotonic()
+			self._condition.notify()
+
+	def is_superseded(self, file_path):
+		"""
+		Tells whether a newer event for the path arrived after it was taken off the queue.
+
+		Parameters:
+			file_path (str): The path being re-indexed.
+
+		Returns:
+			bool: True if the path is queued again, in which case the current pass skips it.
+		"""
+		with self._condition:
+			return os.path.relpath(file_path) in self._pending
+
+	def stop(self):
+		"""
+		Stops the worker once the current pass is finished and the snapshot is saved.
+
+		Returns:
+			None
+		"""
+		with self._condition:
+			self._stopped = True
+			self._condition.notify()
+
+	def run(self):
+		"""
+		Waits for paths to become quiet and re-indexes them in batches until stopped, saving the snapshot when it is due.
+
+		Returns:
+			None
+		"""
+		while True:
+			with self._condition:
+				ready, save = [], False
+				while not self._stopped:
+					now = time.monotonic()
+					ready = [path for path, changed_at in self._pending.items() if now - changed_at >= self.quiet_window]
+					unsaved_since = self.handler.unsaved_since
+					save = unsaved_since is not None and now - unsaved_since >= self.snapshot_interval
+					if ready or save:
+						break
+					deadlines = [changed_at + self.quiet_window for changed_at in self._pending.values()]
+					if unsaved_since is not None:
+						deadlines.append(unsaved_since + self.snapshot_interval)
+					self._condition.wait(min(deadlines) - now if deadlines else None)
+				if self._stopped:
+					break
+				for path in ready:
+					del self._pending[path]
+			if ready:
+				try:
+					self.handler.update_files(ready, is_superseded=self.is_superseded)
+				except Exception as e:
+					print(f"\U000026A0 Error in re-indexing files: {e}")
+			if save:
+				self.save_snapshot()
+		if self.handler.unsaved_since is not None:
+			self.save_snapshot()
+
+	def save_snapshot(self):
+		try:
+			self.handler.save_snapshot()
+		except Exception as e:
+			print(f"\U000026A0 Error in saving the snapshot: {e}")
+
+def normalize_question(text):
+	"""
+	Normalizes a question so that trivially different phrasings share cache entries.
+
+	Parameters:
+		text (str): The question as typed or recognized.
+
+	Returns:
+		str: The lowercased question with collapsed whitespace and without trailing punctuation.
+	"""
+	return " ".join(text.lower().split()).rstrip(" ?!.")
+
+class QueryEmbeddingCache:
+	def __init__(self, embeddings, model=None, max_size=QUERY_CACHE_SIZE, persist=PERSIST_QUERY_CACHE, save_delay=30.0):
+		"""
+		Initializes a bounded LRU cache of question embeddings.
+
+		New entries are saved on a background timer, save_delay seconds after the first one, and by save() on exit, so a question never waits for the cache file to be written.
+
+		Parameters:
+			embeddings (Embeddings): The embeddings used on a cache miss.
+			model (str): (optional) The embedding model, part of every key. Defaults to the embedding_id of embeddings.
+			max_size (int): (optional) The maximum number of cached questions.
+			persist (bool): (optional) Whether the cache is loaded from and saved to CACHE_DIR.
+			save_delay (float): (optional) Seconds new entries wait before they are saved.
+
+		Returns:
+			None
+		"""
+		self.embeddings = embeddings
+		self.model = model or embedding_id(embeddings)
+		self.max_size = max_size
+		self.path = os.path.join(CACHE_DIR, "query_embeddings.json") if persist else None
+		self.save_delay = save_delay
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self._save_lock = threading.Lock()  # Keeps the timer and an exit from writing the file at once
+		self._saver = None  # Timer of the pending save, None when everything is saved
+		self.load()
+
+	def load(self):
+		"""
+		Loads the persisted entries, if any were saved for the same model.
+
+		Returns:
+			None
+		"""
+		if self.path is None:
+			return
+		try:
+			with open(self.path, 'r') as file:
+				data = json.load(file)
+		except Exception as e:
+			return
+		if data.get("model") == self.model:
+			self._entries.update((key, vector) for key, vector in data.get("entries", [])[-self.max_size:])
+
+	def save(self):
+		"""
+		Saves the entries to CACHE_DIR when persistence is enabled and some were added since the last save.
+
+		Returns:
+			None
+		"""
+		if self.path is None:
+			return
+		with self._save_lock:
+			with self._lock:
+				if self._saver is None:
+					return
+				self._saver.cancel()
+				self._saver = None
+				entries = list(self._entries.items())
+			try:
+				os.makedirs(os.path.dirname(self.path), exist_ok=True)
+				with open(self.path + ".tmp", 'w') as file:
+					json.dump({"model": self.model, "entries": entries}, file)
+				os.replace(self.path + ".tmp", self.path)
+			except OSError as e:
+				print(f"\U000026A0 Error in saving the query cache: {e}")
+
+	def embed_query(self, text):
+		"""
+		Returns the embedding of a question, embedding it only if its normalized form is not cached yet.
+
+		Parameters:
+			text (str): The question.
+
+		Returns:
+			list: The embedding of the question.
+		"""
+		key = normalize_question(text)
+		with self._lock:
+			if key in self._entries:
+				self._entries.move_to_end(key)
+				return self._entries[key]
+		with metrics.measure("query_embed", size=len(text)):
+			vector = list(self.embeddings.embed_query(text))
+		with self._lock:
+			self._entries[key] = vector
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+			if self.path is not None and self._saver is None:
+				self._saver = threading.Timer(self.save_delay, self.save)
+				self._saver.daemon = True
+				self._saver.start()
+		return vector
+
+def question_embeddings():
+	"""
+	Returns the cache of question embeddings, building it on first use.
+
+	Returns:
+		QueryEmbeddingCache: The cache, backed by default_embedder().
+	"""
+	global query_embeddings
+	embeddings = default_embedder()
+	with _clients_lock:
+		if query_embeddings is None:
+			query_embeddings = QueryEmbeddingCache(embeddings)
+		return query_embeddings
+
+def shut_down(knowledge):
+	"""
+	Stops the re-index workers and saves what is only kept in memory so far: the knowledge base snapshots and the cached question embeddings.
+
+	Parameters:
+		knowledge (ShardedKnowledgeBase): The knowledge base.
+
+	Returns:
+		None
+	"""
+	knowledge.stop()
+	if query_embeddings is not None:
+		query_embeddings.save()
+
+class AnswerCache:
+	def __init__(self, max_size=ANSWER_CACHE_SIZE):
+		"""
+		Initializes a bounded LRU cache of LLM answers.
+
+		An answer is keyed by the normalized question, the content of the chunks it was given and the LLM settings, and is dropped as soon as one of the files it was built from is re-indexed.
+
+		Parameters:
+			max_size (int): (optional) The maximum number of cached answers.
+
+		Returns:
+			None
+		"""
+		self.max_size = max_size
+		self._entries = collections.OrderedDict()  # Key -> (answer, source paths)
+		self._keys_by_file = collections.defaultdict(set)
+		self._lock = threading.Lock()
+
+	def key(self, question, docs):
+		"""
+		Builds the cache key of a question asked against a set of retrieved chunks.
+
+		Parameters:
+			question (str): The question.
+			docs (list): The retrieved Documents.
+
+		Returns:
+			str: The cache key.
+		"""
+		chunk_hashes = sorted(
+			hashlib.sha256(f"{doc.metadata.get('source')}\n{doc.page_content}".encode()).hexdigest() for doc in docs
+		)
+		payload = json.dumps([normalize_question(question), chunk_hashes, LLM_SETTINGS], sort_keys=True)
+		return hashlib.sha256(payload.encode()).hexdigest()
+
+	def get(self, key):
+		"""
+		Returns the cached answer for a key.
+
+		Parameters:
+			key (str): The key returned by key().
+
+		Returns:
+			str: The cached answer, or None.
+		"""
+		with self._lock:
+			if key not in self._entries:
+				return None
+			self._entries.move_to_end(key)
+			return self._entries[key][0]
+
+	def put(self, key, answer, docs):
+		"""
+		Caches an answer.
+
+		Parameters:
+			key (str): The key returned by key().
+			answer (str): The answer to cache.
+			docs (list): The Documents the answer was built from.
+
+		Returns:
+			None
+		"""
+		if self.max_size <= 0:
+			return
+		sources = {doc.metadata.get('source') for doc in docs}
+		with self._lock:
+			self._entries[key] = (answer, sources)
+			for source in sources:
+				self._keys_by_file[source].add(key)
+			while len(self._entries) > self.max_size:
+				self._forget(next(iter(self._entries)))
+
+	def invalidate_file(self, file_path):
+		"""
+		Drops every answer that was built from chunks of a file.
+
+		Parameters:
+			file_path (str): The path of the re-indexed file.
+
+		Returns:
+			None
+		"""
+		with self._lock:
+			for key in list(self._keys_by_file.pop(file_path, ())):
+				self._forget(key)
+
+	def _forget(self, key):
+		answer, sources = self._entries.pop(key, (None, ()))
+		for source in sources:
+			keys = self._keys_by_file.get(source)
+			if keys is not None:
+				keys.discard(key)
+				if not keys:
+					del self._keys_by_file[source]
+
+class AudioPlayer(threading.Thread):
+	def __init__(self):
+		"""
+		Initializes the playback service.
+
+		The player owns the pygame mixer on its own thread: the mixer is initialized once, clips are played one after another from a queue, the end of a clip is awaited as a pygame event rather than by polling, and played temp files are deleted on a separate cleanup thread. If the mixer cannot be initialized (no audio device, pygame missing), the player disables itself and clips are dropped.
+
+		Returns:
+			None
+		"""
+		super().__init__(daemon=True)
+		self._clips = queue.Queue()
+		self._cleanup = queue.Queue()
+		self._start_lock = threading.Lock()  # Guards starting the thread, disabled and queueing clips
+		self._idle = threading.Condition()  # Guards and signals the clips in flight
+		self._in_flight = 0  # Clips queued or playing
+		self._last_played = 0.0  # Monotonic time a clip last played
+		self.disabled = False
+
+	def play(self, file_path, delete=True):
+		"""
+		Queues a clip, starting the player on first use.
+
+		Parameters:
+			file_path (str): The path to the audio file.
+			delete (bool): Whether the file is deleted after playing.
+
+		Returns:
+			threading.Event: Set once the clip has finished playing, or right away if the player is disabled.
+		"""
+		done = threading.Event()
+		with self._start_lock:
+			if not self.disabled:
+				if self.ident is None:
+					self.start()
+				with self._idle:
+					self._in_flight += 1
+				self._clips.put((file_path, delete, done))
+				return done
+		self._drop(file_path, delete, done)
+		return done
 
-		Parameters:
-		    ignore_list (list): A list of items to ignore. Defaults to an empty list.
+	def stop(self):
+		"""
+		Stops the player once the queued clips have been played.
 
 		Returns:
-		    None
-		"""
-		super().__init__()
-		self._busy_files = {}
-		self.cooldown = 5.0  # Cooldown in seconds
-		self.ignore_list = IGNORE_THESE  # Ignore list
-		self.data = {}
-		self.knowledge_base = {}
-		self.embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001",task_type="retrieval_query")
-	def should_ignore(self, filename):
+			None
 		"""
-		Determines whether a given filename should be ignored.
+		self._clips.put((None, False, None))
 
-		Parameters:
-			filename (str): The name of the file to be checked.
+	def wait_idle(self):
+		"""
+		Blocks until every queued clip has been played.
 
 		Returns:
-			bool: True if the filename should be ignored, False otherwise.
+			None
 		"""
-		current_time = time.time()
-
-		# Check if the file is in the ignore list
-		for item in self.ignore_list:
-			if item in filename:
-				return True
+		with self._idle:
+			self._idle.wait_for(lambda: self._in_flight == 0)
 
-		# Check if the file is in the busy files and within the cooldown period
-		if filename in self._busy_files:
-			if current_time - self._busy_files[filename] < self.cooldown:
-				return True
+	def played_since(self, moment):
+		"""
+		Tells whether anything was played since a moment, e.g. while the microphone was listening.
 
-		# # Update the busy files dictionary
-		# self._busy_files[filename] = current_time
-		return False
+		Parameters:
+			moment (float): A time.monotonic() value.
 
-	def on_modified(self, event):
+		Returns:
+			bool: True if a clip is queued or playing, or finished after moment.
 		"""
-		Handles the on_modified event.
+		with self._idle:
+			return self._in_flight > 0 or self._last_played >= moment
 
-		:param event: The event object containing information about the modified file.
+	def run(self):
 		"""
-		if ".mp3" not in event.src_path:
-			if not self.should_ignore(event.src_path):
-				print(f'\n\U0001F4BE The file {event.src_path} has changed!')
-				self.update_file_content()
+		Plays queued clips until stopped.
 
-	def update_file_content(self):
+		Returns:
+			None
 		"""
-		Update the content of files in the current directory.
+		# pygame only delivers events with the video subsystem up, which needs no window with the dummy driver
+		os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+		try:
+			pygame = timed_import("pygame")
+			pygame.display.init()
+			pygame.mixer.init()
+		except Exception as e:
+			print(f"\nError in initializing audio, answers will not be played: {e}")
+			with self._start_lock:
+				self.disabled = True
+			# Nothing is queued after disabled is set, release whoever waits on the clips queued before
+			while not self._clips.empty():
+				file_path, delete, done = self._clips.get()
+				if file_path is not None:
+					self._drop(file_path, delete, done)
+					self._finished()
+			return
+		end_event = pygame.USEREVENT + 1
+		pygame.mixer.music.set_endevent(end_event)
+		threading.Thread(target=self._clean_up, daemon=True).start()
+		while True:
+			file_path, delete, done = self._clips.get()
+			if file_path is None:
+				self._cleanup.put(None)
+				return
+			try:
+				pygame.event.clear(end_event)
+				pygame.mixer.music.load(file_path)
+				pygame.mixer.music.play()
+				while True:
+					event = pygame.event.wait(500)
+					if event.type == end_event or (event.type == pygame.NOEVENT and not pygame.mixer.music.get_busy()):
+						break
+				pygame.mixer.music.unload()
+			except Exception as e:
+				print(f"\nError in playing audio: {e}")
+			if delete:
+				self._cleanup.put(file_path)
+			done.set()
+			self._finished()
 
-		This function collects all the files in the current directory and its subdirectories and updates their content. It performs the following steps:
+	def _finished(self):
+		with self._idle:
+			self._in_flight -= 1
+			self._last_played = time.monotonic()
+			self._idle.notify_all()
 
-		1. Checks if the ".env" file is in the ignore list. If it is not, it prompts a warning message asking for confirmation to include the ".env" file. If the user does not confirm, the function exits.
-		2. Iterates over all the files in the current directory and its subdirectories, excluding the directories in the ignore list and the files in the ignore list.
-		3. For each file, it reads its content and stores it in a dictionary. If the file is a JSON file, it stores the JSON data in the dictionary. Otherwise, it stores the content of each line in the dictionary.
-		4. Creates a final dictionary containing all the collected file data.
-		5. Converts the final dictionary to a JSON string and splits it into chunks.
-		6. Creates or updates the knowledge base using the chunks of the JSON string.
-		7. Prints a success message and plays an audio indicating that the files have been updated and the function is ready for questions.
+	def _drop(self, file_path, delete, done):
+		if delete:
+			try:
+				os.unlink(file_path)
+			except OSError:
+				pass
+		done.set()
 
-		Note: Make sure to add ".env" to the ignore list to prevent exposing sensitive information to OpenAI.
+	def _clean_up(self):
+		while True:
+			file_path = self._cleanup.get()
+			if file_path is None:
+				return
+			try:
+				os.unlink(file_path)  # Delete the temporary file
+				print("Deleted temp audio file in: " + file_path)
+			except OSError as e:
+				print(f"\nError in deleting audio: {e}")
 
-		Parameters:
-		- self: The current instance of the class.
+audio_player = AudioPlayer()
 
-		Return:
-		- None
-		"""
-		print("\n\U0001F4C1 Collecting files...")
-		all_files_data = {}
-		# Check if ".env" is in ignore list, if not prompt warning "Are you sure you want to include your .env in your api call to OpenAI?"
-		if ".env" not in self.ignore_list:
-			response = input("😨 You removed .env from ignore list. This may expose .env variables to OpenAI. Confirm? (1 for Yes, 2 for exit):")
-			if response != "1":
-				print("\n😅 Phew. Close one... Operation aborted. Please add '.env' to your ignore list and try again.")
-				exit()
-		for root, dirs, files in os.walk('.'):
-			# Remove directories in the ignore list
-			dirs[:] = [d for d in dirs if d not in self.ignore_list]
-			for filename in files:
-				if filename not in self.ignore_list:
-					file_path = os.path.join(root, filename)
-					try:
-						with open(file_path, 'r') as file:
-							if filename.endswith('.json'):
-								json_data = json.load(file)
-								all_files_data[file_path] = json_data  # Store JSON data in the dictionary
-							else:
-								lines = file.readlines()
-								line_data = {}
-								for i, line in enumerate(lines):
-									line_data[f"line {i + 1}"] = line.strip()
-								all_files_data[file_path] = line_data
-					except Exception as e:
-						continue
-						#print(f'\U000026A0 Error reading file {file_path}: {str(e)}')
-	
-		# Create the final dictionary with the desired format
-		final_data = {"files": all_files_data}
-		combined_text = json.dumps(final_data)
-	
-		# Split combined text into chunks
-		text_splitter = CharacterTextSplitter(
-			separator=",",
-			chunk_size=1000,
-			chunk_overlap=200,
-			length_function=len,
-		)
-		chunks = text_splitter.split_text(combined_text)
-		# print(combined_text)
-		# Create or update the knowledge base
-		self.knowledge_base = FAISS.from_texts(chunks, self.embeddings)
-		print(self.knowledge_base.index)
-		print("\U00002705 All set!")
-		audio_stream = create_audio("Files updated. Ready for questions")
-		play_audio(audio_stream)
-
-def play_audio(file_path):
+def play_audio(file_path, delete=True, wait=False):
 	"""Play audio from a file.
 
-	Loads the audio file at the given path into the pygame mixer, 
-	plays it, waits for playback to finish, unloads the file, 
+	Queues the audio file at the given path on the audio player, 
+	which plays it after the clips queued before it, unloads the file, 
 	and deletes the temporary file.
 
 	Args:
 		file_path (str): The path to the audio file.
-	"""
-	pygame.mixer.init()
-	pygame.mixer.music.load(file_path)
-	pygame.mixer.music.play()
+		delete (bool): Whether the file is deleted after playing. Cached phrases are kept.
+		wait (bool): Whether to block until the clip has finished playing.
 
-	while pygame.mixer.music.get_busy():
-		continue
-
-	pygame.mixer.music.unload()
-	os.unlink(file_path)  # Delete the temporary file
-	print("Deleted temp audio file in: " + file_path)
+	Returns:
+		threading.Event: Set once the clip has finished playing.
+	"""
+	done = audio_player.play(file_path, delete)
+	if wait:
+		done.wait()
+	return done
 
 def create_audio(text: str) -> str:
     """
@@ -192,13 +2659,72 @@ def create_audio(text: str) -> str:
     temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
     print(f"\nCreated temp audio file in : {temp_file.name}")
     try:
-        speech = gTTS(text=text, lang='en', slow=False)
-        speech.save(temp_file.name)
+        with metrics.measure("tts", size=len(text)):
+            speech = timed_import("gtts").gTTS(text=text, lang='en', slow=False)
+            speech.save(temp_file.name)
     except Exception as e:
         print(f"\nError in creating audio: {e}")
 
     return temp_file.name
 
+def split_sentences(text):
+	"""
+	Splits text into sentences for speech.
+
+	Parameters:
+		text (str): The text to split.
+
+	Returns:
+		list: The non-empty sentences, in order.
+	"""
+	return [sentence.strip() for sentence in re.split(r'(?<=[.!?])\s+|\n+', text) if sentence.strip()]
+
+def speak(text):
+	"""
+	Speaks text sentence by sentence.
+
+	The sentences are synthesized on TTS_CONCURRENCY threads and queued on the audio player in order as soon as each one is ready, so the first sentence starts playing after its own synthesis instead of after the whole answer. Returns once every sentence is queued.
+
+	Parameters:
+		text (str): The text to speak.
+
+	Returns:
+		None
+	"""
+	sentences = split_sentences(text)
+	if not sentences:
+		return
+	with ThreadPoolExecutor(max_workers=TTS_CONCURRENCY) as executor:
+		clips = [executor.submit(create_audio, sentence) for sentence in sentences]
+		for clip in clips:
+			play_audio(clip.result())
+
+def speak_phrase(text):
+	"""
+	Speaks a fixed phrase, synthesizing it only the first time. Does nothing unless speech I/O was chosen.
+
+	The audio of every phrase is kept in CACHE_DIR, keyed by a hash of its text.
+
+	Parameters:
+		text (str): The phrase to speak.
+
+	Returns:
+		None
+	"""
+	if not speech_output:
+		return
+	file_path = os.path.join(CACHE_DIR, "phrases", hashlib.sha256(text.encode()).hexdigest() + ".mp3")
+	if not os.path.exists(file_path):
+		os.makedirs(os.path.dirname(file_path), exist_ok=True)
+		try:
+			with metrics.measure("tts", size=len(text)):
+				timed_import("gtts").gTTS(text=text, lang='en', slow=False).save(file_path + ".tmp")
+			os.replace(file_path + ".tmp", file_path)
+		except Exception as e:
+			print(f"\nError in creating audio: {e}")
+			return
+	play_audio(file_path, delete=False)
+
 def count_tokens(text):
 	"""
 	Count the number of tokens in a given text.
@@ -213,59 +2739,659 @@ def count_tokens(text):
 	tokens = text.split()
 	# Đếm và trả về số lượng token
 	return len(tokens)	
-def generate_response(prompt, speak_response:bool = False):
+
+def estimate_tokens(text):
+	"""
+	Estimates the number of LLM tokens of a text, at roughly four characters per token.
+
+	Parameters:
+	- text (str): The text to measure.
+
+	Returns:
+	- int: The estimated number of tokens.
+	"""
+	return max(len(text) // 4, count_tokens(text))
+
+def pack_context(docs, budget):
+	"""
+	Renders retrieved chunks into a compact context that fits a token budget.
+
+	Chunks of the same file are merged by line, so overlapping and adjacent chunks become one block without repeated text. Blocks whose text already appeared elsewhere are dropped. Every block gets a "path:start-end" header, and blocks are added in order of relevance until the budget is used up, the last one cut to fit.
+
+	Parameters:
+	- docs (list): The retrieved Documents, best first.
+	- budget (int): The maximum number of tokens of the context.
+
+	Returns:
+	- str: The context.
+	"""
+	files = {}  # File path -> {line number: text}, in order of the best chunk of each file
+	ranks = []  # (rank, file path, start line) of every chunk
+	for rank, doc in enumerate(docs):
+		source = doc.metadata.get("source", "?")
+		start = doc.metadata.get("start_line", 1)
+		lines = files.setdefault(source, {})
+		for offset, line in enumerate(doc.page_content.split("\n")):
+			lines[start + offset] = line
+		ranks.append((rank, source, start))
+	blocks = {}  # (file path, first line) -> (rank, header, text)
+	for source, lines in files.items():
+		numbers = sorted(lines)
+		first = previous = numbers[0]
+		for number in numbers[1:] + [None]:
+			if number is not None and number == previous + 1:
+				previous = number
+				continue
+			rank = min(rank for rank, path, start in ranks if path == source and first <= start <= previous)
+			text = "\n".join(lines[line] for line in range(first, previous + 1))
+			blocks[(source, first)] = (rank, f"### {source}:{first}-{previous}", text)
+			if number is not None:
+				first = previous = number
+	context, used, seen = [], 0, set()
+	for rank, header, text in sorted(blocks.values(), key=lambda block: block[0]):
+		fingerprint = hashlib.sha256(text.strip().encode()).hexdigest()
+		if fingerprint in seen:
+			continue
+		seen.add(fingerprint)
+		cost = estimate_tokens(header) + estimate_tokens(text) + 1
+		if used + cost > budget:
+			remaining, kept = budget - used - estimate_tokens(header) - 2, []
+			for line in text.split("\n"):
+				remaining -= estimate_tokens(line) + 1
+				if remaining < 0:
+					break
+				kept.append(line)
+			if len(kept) >= 3:
+				context.append(f"{header}\n" + "\n".join(kept) + "\n...")
+			break
+		context.append(f"{header}\n{text}")
+		used += cost
+	return "\n\n".join(context)
+
+def build_prompt(question, docs, max_tokens=MAX_TOKENS_PER_CALL):
+	"""
+	Builds the LLM prompt for a question, keeping it within max_tokens.
+
+	Parameters:
+	- question (str): The question.
+	- docs (list): The retrieved Documents, best first.
+	- max_tokens (int): (optional) The token budget of the whole prompt.
+
+	Returns:
+	- str: The prompt.
+	"""
+	prompt = "You are an expert programmer who is aware of this much of the code base:\n"
+	instructions = "\n\nPlease answer this: " + question + "..." # Add the rest of your instructions here
+	return prompt + pack_context(docs, max_tokens - estimate_tokens(prompt + instructions)) + instructions
+
+def token_usage(message, prompt, answer):
+	"""
+	Tells how many tokens a chat model call used.
+
+	Parameters:
+		message (AIMessage): The message returned by the model. Its usage_metadata is used when the model reported it.
+		prompt (str): The prompt, to estimate the usage otherwise.
+		answer (str): The answer, to estimate the usage otherwise.
+
+	Returns:
+		dict: input_tokens, output_tokens and reported, False when the counts are estimates.
+	"""
+	usage = getattr(message, "usage_metadata", None) or {}
+	if usage.get("input_tokens") or usage.get("output_tokens"):
+		return {"input_tokens": usage.get("input_tokens", 0), "output_tokens": usage.get("output_tokens", 0), "reported": True}
+	return {"input_tokens": estimate_tokens(prompt), "output_tokens": estimate_tokens(answer), "reported": False}
+
+def describe_usage(usage):
+	"""
+	Formats a token_usage result for printing.
+
+	Parameters:
+		usage (dict): The token_usage result.
+
+	Returns:
+		str: e.g. "1200 in, 85 out" or "~1200 in, ~85 out" for estimates.
+	"""
+	mark = "" if usage["reported"] else "~"
+	return f"{mark}{usage['input_tokens']} in, {mark}{usage['output_tokens']} out"
+
+def stream_chat(llm, prompt, usage=None):
+	"""
+	Streams the answer of a chat model, recording its latency and token usage in metrics.
+
+	Parameters:
+		llm (BaseChatModel): The chat model.
+		prompt (str): The prompt.
+		usage (dict): (optional) Receives the token_usage result once the answer is complete.
+
+	Returns:
+		generator: The pieces of the answer, as they arrive.
+	"""
+	started = time.perf_counter()
+	parts, reported = [], collections.Counter()
+	for chunk in llm.stream(prompt):
+		if not parts:
+			metrics.observe("llm_first_token", time.perf_counter() - started)
+		# Streamed chunks carry the usage of their own part of the answer
+		reported.update({key: value for key, value in (getattr(chunk, "usage_metadata", None) or {}).items() if key in ("input_tokens", "output_tokens")})
+		parts.append(chunk.content)
+		yield chunk.content
+	answer = "".join(parts)
+	result = token_usage(SimpleNamespace(usage_metadata=dict(reported)), prompt, answer)
+	metrics.observe("llm", time.perf_counter() - started, size=len(answer))
+	metrics.add_tokens(result["input_tokens"], result["output_tokens"], result["reported"])
+	if usage is not None:
+		usage.update(result)
+
+def generate_response(prompt, speak_response:bool = False, stream:bool = STREAM_RESPONSES, llm=None):
 	"""
 	Generates a response based on the given prompt.
 
 	Parameters:
 	- prompt: A string representing the prompt for generating the response.
 	- speak_response: (optional) A boolean indicating whether the response should be spoken aloud.
+	- stream: (optional) A boolean indicating whether the response is printed token by token as it arrives. The token count and speech still happen once it is complete.
+	- llm: (optional) The chat model to use instead of chat_model().
 
 	Returns:
-	- None
+	- str: The text of the response, or None if it could not be generated.
 
 	Raises:
 	- Exception: If there is an error in generating the response.
 	"""
 
+	llm = llm or chat_model()
 	try:
-		response_text = llm_text.invoke(prompt)
-		print("\n\U0001F4B0 Tokens used:", count_tokens(response_text.content))
-		print('\U0001F916', response_text.content)
+		if stream:
+			print('\n\U0001F916 ', end='', flush=True)
+			parts, usage = [], {}
+			for piece in stream_chat(llm, prompt, usage):
+				print(piece, end='', flush=True)
+				parts.append(piece)
+			print()
+			content = "".join(parts)
+			print("\U0001F4B0 Tokens used:", describe_usage(usage))
+		else:
+			with metrics.measure("llm") as counts:
+				message = llm.invoke(prompt)
+				content = message.content
+				counts["size"] = len(content)
+			usage = token_usage(message, prompt, content)
+			metrics.add_tokens(usage["input_tokens"], usage["output_tokens"], usage["reported"])
+			print("\n\U0001F4B0 Tokens used:", describe_usage(usage))
+			print('\U0001F916', content)
 		if speak_response:
-			audio_stream = create_audio(response_text.content)
-			play_audio(audio_stream)
+			speak(content)
+		return content
 	except Exception as e:
 		print(f"\U000026A0 Error in generating response: {e}")
+		return None
+
+def answer_question(knowledge, question, scope=None, llm=None, usage=None):
+	"""
+	Answers a question, yielding the answer as it is generated.
+
+	Navigation questions are answered from the symbol indexes and repeated questions from the answer cache, everything else is streamed from the chat model and cached once complete.
+
+	Parameters:
+		knowledge (ShardedKnowledgeBase): The knowledge base to search.
+		question (str): The question, without its @path scopes.
+		scope (list): (optional) Only files under these directories are searched.
+		llm (BaseChatModel): (optional) The chat model to use instead of chat_model().
+		usage (dict): (optional) Receives the token_usage result when the chat model answered.
+
+	Returns:
+		generator: (source, text) pairs. source is "navigation", "empty", "cached" or "llm". Only "llm" answers come in several pieces.
+	"""
+	navigation = knowledge.navigate(question, scope)
+	if navigation is not None:
+		yield "navigation", navigation
+		return
+	if knowledge.is_empty(scope):
+		yield "empty", "The knowledge base is empty. Add some files and try again."
+		return
+	query_embedding = question_embeddings().embed_query(question)
+	docs = knowledge.search(question, query_embedding, scope=scope)
+	answer_key = knowledge.answer_cache.key(question, docs)
+	answer = knowledge.answer_cache.get(answer_key)
+	if answer is not None:
+		yield "cached", answer
+		return
+	parts = []
+	for piece in stream_chat(llm or chat_model(), build_prompt(question, docs), usage):
+		parts.append(piece)
+		yield "llm", piece
+	knowledge.answer_cache.put(answer_key, "".join(parts), docs)
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+	"""
+	Serves the metrics: GET /metrics in the Prometheus text format and GET /metrics.json as a Metrics.snapshot.
+	"""
+	protocol_version = "HTTP/1.1"
+	server_version = "cody"
+
+	def do_GET(self):
+		if self.authorized() and not self.serve_metrics(urlsplit(self.path).path):
+			self.send_json(404, {"error": "not found"})
+
+	def serve_metrics(self, path):
+		"""
+		Answers a request for the metrics.
+
+		Parameters:
+			path (str): The requested path.
+
+		Returns:
+			bool: True if the path was a metrics path and has been answered.
+		"""
+		if path == "/metrics.json":
+			self.send_json(200, metrics.snapshot())
+		elif path == "/metrics":
+			data = metrics.prometheus().encode()
+			self.send_response(200)
+			self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+			self.send_header("Content-Length", str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+		else:
+			return False
+		return True
+
+	def authorized(self):
+		"""
+		Checks the bearer token when DAEMON_TOKEN is set, answering 401 otherwise.
+
+		Returns:
+			bool: True if the request may proceed.
+		"""
+		if not DAEMON_TOKEN or hmac.compare_digest(self.headers.get("Authorization", "").encode(), f"Bearer {DAEMON_TOKEN}".encode()):
+			return True
+		self.send_json(401, {"error": "unauthorized"})
+		return False
+
+	def send_json(self, status, payload):
+		data = json.dumps(payload).encode()
+		self.send_response(status)
+		if status >= 400:
+			self.send_header("Connection", "close")  # The request body may not have been read
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def address_string(self):
+		# Unix socket peers have no address
+		return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+	def log_message(self, format, *args):
+		pass  # Requests are not logged, QueryRequestHandler.ask logs every question
+
+class QueryRequestHandler(MetricsRequestHandler):
+	"""
+	Serves the daemon's query API.
+
+	GET /status returns the indexed roots as JSON, GET /metrics and /metrics.json the metrics. POST /ask with {"question": "...", "scope": ["path", ...]} (scope optional, @path in the question works too), or GET /ask?q=..., streams the answer back as chunked plain text. The X-Cody-Source header tells where the answer came from, see answer_question.
+	"""
+	def do_GET(self):
+		url = urlsplit(self.path)
+		if not self.authorized():
+			return
+		if url.path == "/status":
+			self.send_json(200, self.server.status())
+		elif url.path == "/ask":
+			self.ask(parse_qs(url.query).get("q", [""])[0], None)
+		elif not self.serve_metrics(url.path):
+			self.send_json(404, {"error": "not found"})
+
+	def do_POST(self):
+		if not self.authorized():
+			return
+		if urlsplit(self.path).path != "/ask":
+			self.send_json(404, {"error": "not found"})
+			return
+		try:
+			body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+			question, scope = str(body.get("question", "")), body.get("scope")
+		except (ValueError, AttributeError):
+			self.send_json(400, {"error": "expected a JSON object with a question"})
+			return
+		if scope is not None and not (isinstance(scope, list) and all(isinstance(path, str) and path for path in scope)):
+			self.send_json(400, {"error": "scope must be a list of paths"})
+			return
+		self.ask(question, scope)
+
+	def ask(self, text, scope):
+		"""
+		Answers a question, streaming the answer as chunked plain text.
+
+		Parameters:
+			text (str): The question as asked, possibly with @path scopes.
+			scope (list): Extra directories to scope the question to, or None.
+
+		Returns:
+			None
+		"""
+		question, parsed_scope = parse_scope(text)
+		if scope is not None or parsed_scope is not None:
+			scope = [os.path.relpath(path) for path in scope or ()] + (parsed_scope or [])
+		if not question:
+			self.send_json(400, {"error": "empty question"})
+			return
+		print(f"\U0001F9E0 [{self.address_string()}] {question}")
+		answer = answer_question(self.server.knowledge, question, scope)
+		try:
+			source, text = next(answer)
+		except Exception as e:
+			self.send_json(500, {"error": f"error in generating response: {e}"})
+			return
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; charset=utf-8")
+		self.send_header("Transfer-Encoding", "chunked")
+		self.send_header("X-Cody-Source", source)
+		self.end_headers()
+		try:
+			self.write_chunk(text)
+			for _, text in answer:
+				self.write_chunk(text)
+		except (BrokenPipeError, ConnectionResetError):
+			answer.close()  # The client is gone, stop generating
+			return
+		except Exception as e:
+			self.write_chunk(f"\n\U000026A0 Error in generating response: {e}")
+		self.wfile.write(b"0\r\n\r\n")
+
+	def write_chunk(self, text):
+		data = text.encode()
+		if data:
+			self.wfile.write(b"%X\r\n%s\r\n" % (len(data), data))
+			self.wfile.flush()
+
+class QueryServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address, knowledge):
+		"""
+		Initializes the daemon's HTTP server on a TCP address.
+
+		Parameters:
+			address (tuple): (host, port).
+			knowledge (ShardedKnowledgeBase): The knowledge base questions are answered from.
+
+		Returns:
+			None
+		"""
+		self.knowledge = knowledge
+		super().__init__(address, QueryRequestHandler)
+
+	def status(self):
+		"""
+		Describes what the daemon has indexed.
+
+		Returns:
+			dict: The files and chunks of every root.
+		"""
+		roots = []
+		for shard in self.knowledge.shards:
+			with shard.lock:
+				roots.append({"root": shard.root, "files": len(shard.file_chunk_ids), "chunks": sum(len(ids) for ids in shard.file_chunk_ids.values())})
+		return {"roots": roots}
+
+class UnixQueryServer(QueryServer):
+	address_family = socket.AF_UNIX
+
+	def server_bind(self):
+		# HTTPServer.server_bind expects a (host, port) address
+		if os.path.exists(self.server_address) and stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+			os.remove(self.server_address)  # Left behind by a previous run
+		socketserver.TCPServer.server_bind(self)
+		self.server_name, self.server_port = "localhost", 0
+
+def start_daemon():
+	"""
+	Starts Cody as a headless daemon that keeps the knowledge base warm and answers questions over a local HTTP API, see QueryRequestHandler.
+
+	Parameters:
+		None
+
+	Returns:
+		None
+	"""
+	knowledge = ShardedKnowledgeBase(ROOTS, ignore_list=IGNORE_THESE)
+	knowledge.update_file_content()
+	if SHOW_IMPORT_TIMES:
+		print(import_report())
+
+	observer = timed_import("watchdog.observers").Observer()
+	knowledge.watch(observer)
+	observer.start()
+
+	if DAEMON_SOCKET:
+		server = UnixQueryServer(DAEMON_SOCKET, knowledge)
+		print(f"\U0001F50C Listening on unix:{DAEMON_SOCKET}")
+	else:
+		server = QueryServer((DAEMON_HOST, DAEMON_PORT), knowledge)
+		print(f"\U0001F50C Listening on http://{DAEMON_HOST}:{DAEMON_PORT}")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if DAEMON_SOCKET and os.path.exists(DAEMON_SOCKET):
+			os.remove(DAEMON_SOCKET)
+		observer.stop()
+		shut_down(knowledge)
+	observer.join()
+
+def listen(recognizer):
+	"""
+	Listens to the microphone and transcribes what was said.
+
+	Listening only starts once the audio player is idle, and what was heard is dropped if a clip played meanwhile.
+
+	Parameters:
+		recognizer (speech_recognition.Recognizer): The recognizer to use.
 
-def monitor_input(handler:FileChangeHandler, terminal_input=True):
+	Returns:
+		str: The transcription, or None if nothing could be understood or an answer was playing.
+	"""
+	sr = timed_import("speech_recognition")
+	# The microphone would pick up the answers Cody speaks and ask them back as questions
+	audio_player.wait_idle()
+	try:
+		with sr.Microphone() as source:
+			started = time.monotonic()
+			print("\nListening...")
+			audio_data = recognizer.listen(source)
+		if audio_player.played_since(started):
+			print("\nIgnored what was heard while an answer was playing")
+			return None
+		return recognizer.recognize_google(audio_data)
+	except sr.UnknownValueError:
+		print("\nCould not understand audio")
+	except sr.RequestError as e:
+		print("\nCould not request results; {0}".format(e))
+	return None
+
+async def stream_answer(knowledge, question, scope=None, usage=None):
+	"""
+	Runs answer_question on a worker thread so the event loop stays free while the question is embedded, searched and answered.
+
+	Parameters:
+		knowledge (ShardedKnowledgeBase): The knowledge base to search.
+		question (str): The question, without its @path scopes.
+		scope (list): (optional) Only files under these directories are searched.
+		usage (dict): (optional) Receives the token usage when the chat model answered, see answer_question.
+
+	Returns:
+		async generator: The (source, text) pairs of answer_question, as they are produced.
+	"""
+	loop = asyncio.get_running_loop()
+	pieces = asyncio.Queue()
+
+	def produce():
+		try:
+			for piece in answer_question(knowledge, question, scope, usage=usage):
+				loop.call_soon_threadsafe(pieces.put_nowait, piece)
+		except Exception as e:
+			loop.call_soon_threadsafe(pieces.put_nowait, e)
+		finally:
+			loop.call_soon_threadsafe(pieces.put_nowait, None)
+
+	producer = loop.run_in_executor(None, produce)
+	while True:
+		piece = await pieces.get()
+		if piece is None:
+			break
+		if isinstance(piece, Exception):
+			raise piece
+		yield piece
+	await producer
+
+async def handle_question(knowledge, number, text, spoken=None, in_flight=None):
+	"""
+	Answers one question, every line of the answer tagged with the number of the question.
+
+	With STREAM_RESPONSES on, the answer is printed as it streams in: piece by piece while it is the only question being answered, and in whole lines while other answers could interleave with it. Otherwise it is printed once complete.
+
+	Parameters:
+		knowledge (ShardedKnowledgeBase): The knowledge base to search.
+		number (int): The number of the question, used as its tag.
+		text (str): The question as asked, possibly with @path scopes.
+		spoken (asyncio.Queue): (optional) Receives (number, text) to speak once the answer is complete. None in terminal mode.
+		in_flight (set): (optional) The tasks of the questions being answered, to tell whether a spoken answer needs its tag.
+
+	Returns:
+		None
+	"""
+	tag = f"[#{number}]"
+	icons = {"navigation": "\U0001F9ED", "empty": "\U000026A0", "cached": "\U0001F916 (cached)", "llm": "\U0001F916"}
+	try:
+		question, scope = parse_scope(text)
+		print(f"\n\U0001F9E0 {tag} You asked: " + question)
+		if scope is not None:
+			print(f"\U0001F50E {tag} Searching only under " + ", ".join(scope))
+		source, parts, line, usage = None, [], "", {}
+		started = False  # Whether the beginning of the current line is already printed
+		async for source, piece in stream_answer(knowledge, question, scope, usage):
+			parts.append(piece)
+			if not STREAM_RESPONSES:
+				continue
+			*lines, line = (line + piece).split("\n")
+			if in_flight is None or len(in_flight) <= 1:
+				for i, text in enumerate(lines + [line]):
+					if i:
+						print()
+						started = False
+					if text or i < len(lines):
+						print(("" if started else f"{icons[source]} {tag} ") + text, end="", flush=True)
+						started = True
+				line = ""
+				continue
+			if started:
+				print()  # Another answer may print next, end the line this one started
+				started = False
+			for complete in lines:
+				print(f"{icons[source]} {tag} {complete}")
+		if not STREAM_RESPONSES:
+			*lines, line = "".join(parts).split("\n")
+			for complete in lines:
+				print(f"{icons[source]} {tag} {complete}")
+		if line:
+			print(("" if started else f"{icons[source]} {tag} ") + line)
+		elif started:
+			print()
+		answer = "".join(parts)
+		if source == "llm":
+			print(f"\U0001F4B0 {tag} Tokens used:", describe_usage(usage))
+		if spoken is not None and source is not None:
+			if source == "navigation":
+				answer = answer.splitlines()[0].replace("`", "") + " " + answer.splitlines()[1].strip()
+			if in_flight is not None and len(in_flight) > 1:
+				answer = f"Question {number}. {answer}"
+			await spoken.put((number, answer))
+	except Exception as e:
+		print(f"\U000026A0 {tag} Error in generating response: {e}")
+
+async def speak_answers(spoken):
+	"""
+	Speaks complete answers one after another, so the sentences of concurrent answers never interleave.
+
+	Parameters:
+		spoken (asyncio.Queue): The (number, text) pairs to speak.
+
+	Returns:
+		None
+	"""
+	while True:
+		number, text = await spoken.get()
+		try:
+			await asyncio.to_thread(speak, text)
+		except Exception as e:
+			print(f"\U000026A0 [#{number}] Error in speaking the answer: {e}")
+
+async def answer_questions(knowledge, terminal_input=True):
+	"""
+	Captures questions and answers them concurrently.
+
+	Capturing the next question, retrieving and generating the answers of up to QUESTIONS_IN_FLIGHT earlier ones and synthesizing finished answers all overlap. Spoken questions are only captured while no answer is playing, see listen. Blocking work (input, the microphone, embedding, search, the chat model, speech synthesis) runs on worker threads.
+
+	Parameters:
+		knowledge (ShardedKnowledgeBase): The knowledge base to search.
+		terminal_input (bool): (optional) Whether questions are typed, otherwise they are spoken and answers are spoken back.
+
+	Returns:
+		None
+	"""
+	recognizer = None if terminal_input else timed_import("speech_recognition").Recognizer()
+	spoken = None if terminal_input else asyncio.Queue()
+	speaker = None if terminal_input else asyncio.create_task(speak_answers(spoken))
+	slots = asyncio.Semaphore(QUESTIONS_IN_FLIGHT)
+	in_flight = set()
+	number = 0
 	while True:
 		try:
 			if terminal_input:
-				text = input("\U00002753 Please type your question (or 'exit' to quit): ")
+				text = await asyncio.to_thread(input, "\U00002753 Please type your question (or 'exit' to quit): ")
 			else:
-				with sr.Microphone() as source:
-					print("\nListening...")
-					audio_data = r.listen(source)
-					text = r.recognize_google(audio_data)
-
-			if text.lower() == 'exit':
-				print("\n\U0001F44B Exiting the program...")
-				os._exit(0)
-			else:
-				print(f"You said: {text}")
-				question = text
-				print("\n\U0001F9E0 You asked: " + question)
-				docs = handler.knowledge_base.similarity_search_by_vector(embeds.embed_query(question))
-				response = f"You are an expert programmer who is aware of this much of the code base:{str(docs)}. \n"
-				response += "Please answer this: " + question + "..." # Add the rest of your instructions here
-				generate_response(response)
-		except sr.UnknownValueError:
-			print("\nCould not understand audio")
-		except sr.RequestError as e:
-			print("\nCould not request results; {0}".format(e))
+				text = await asyncio.to_thread(listen, recognizer)
+				if text is None:
+					continue
+		except EOFError:
+			break
 		except Exception as e:
 			print(f"An error occurred: {e}")
+			continue
+
+		if text.lower() == 'exit':
+			print("\n\U0001F44B Exiting the program...")
+			shut_down(knowledge)
+			os._exit(0)
+		if not text.strip():
+			continue
+		print(f"You said: {text}")
+		await slots.acquire()  # Waits here while QUESTIONS_IN_FLIGHT questions are being answered
+		number += 1
+		task = asyncio.create_task(handle_question(knowledge, number, text, spoken, in_flight))
+		in_flight.add(task)
+		task.add_done_callback(in_flight.discard)
+		task.add_done_callback(lambda _: slots.release())
+	if in_flight:
+		await asyncio.wait(in_flight)
+	if speaker is not None:
+		speaker.cancel()
+
+def monitor_input(knowledge:ShardedKnowledgeBase, terminal_input=True):
+	"""
+	Runs the question loop of answer_questions on its own event loop. Meant to be the target of the input thread.
+
+	Parameters:
+		knowledge (ShardedKnowledgeBase): The knowledge base to search.
+		terminal_input (bool): (optional) Whether questions are typed rather than spoken.
+
+	Returns:
+		None
+	"""
+	asyncio.run(answer_questions(knowledge, terminal_input))
 
 def start_cody():
 	"""
@@ -277,24 +3403,34 @@ def start_cody():
 	Returns:
 		None
 	"""
+	global speech_output
+	# Prompt user for interaction method first, so the speech and audio libraries are only loaded for speech I/O
+	interaction_method = input("\nHow should I talk to you? Enter 1 for Terminal or 2 for Speech I/O: ")
+
+	terminal_input = interaction_method == '1'
+	speech_output = not terminal_input
+
 	#ignore_list=IGNORE_THESE
-	handler = FileChangeHandler(ignore_list=IGNORE_THESE)
+	knowledge = ShardedKnowledgeBase(ROOTS, ignore_list=IGNORE_THESE)
 
-	# Collect files before starting the observer
-	handler.update_file_content()  # Directly call the update_file_content method
+	if METRICS_PORT:
+		metrics_server = ThreadingHTTPServer((DAEMON_HOST, METRICS_PORT), MetricsRequestHandler)
+		metrics_server.daemon_threads = True
+		threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+		print(f"\U0001F4C8 Metrics on http://{DAEMON_HOST}:{METRICS_PORT}/metrics")
 
-	# Prompt user for interaction method
-	interaction_method = input("\nHow should I talk to you? Enter 1 for Terminal or 2 for Speech I/O: ")
+	# Collect files before starting the observer
+	knowledge.update_file_content()  # Directly call the update_file_content method
+	if SHOW_IMPORT_TIMES:
+		print(import_report())
 
-	terminal_input = interaction_method == '1'
-	
 	# Start a new thread to monitor input
-	input_thread = threading.Thread(target=monitor_input, args=(handler, terminal_input))
+	input_thread = threading.Thread(target=monitor_input, args=(knowledge, terminal_input))
 	input_thread.start()
 
 	# Initialize the observer
-	observer = Observer()
-	observer.schedule(handler, path='.', recursive=True)
+	observer = timed_import("watchdog.observers").Observer()
+	knowledge.watch(observer)
 	observer.start()
 
 	# Continue to observe for file changes
@@ -303,8 +3439,12 @@ def start_cody():
 			time.sleep(5)
 	except KeyboardInterrupt:
 		observer.stop()
+		shut_down(knowledge)
 
 	observer.join()
 
 if __name__ == "__main__":
-	start_cody()
\ No newline at end of file
+	if "--daemon" in sys.argv[1:]:
+		start_daemon()
+	else:
+		start_cody()
\ No newline at end of file